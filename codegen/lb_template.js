@@ -0,0 +1,2506 @@
+const http = require('http');
+const httpProxy = require('http-proxy');
+const fs = require('fs');
+const path = require('path');
+const zlib = require('zlib');
+const { StringDecoder } = require('string_decoder');
+const { PassThrough } = require('stream');
+const { promisify } = require('util');
+
+// @@GENERATED_CONSTANTS@@
+
+// 从 rewrite 字段推断 model_group（与 antigravity GetModelGroup 保持一致）
+function getModelGroup(rewrite) {
+    if (!rewrite) return '';
+    if (rewrite.includes('gpt')) return 'gpt';
+    if (rewrite.includes('claude')) return 'claude';
+    if (rewrite.includes('gemini')) return 'gemini';
+    return rewrite;
+}
+// signature group → 可处理该组 signature 的 route model 列表
+const signatureGroupModels = new Map();
+for (const [modelName, route] of Object.entries(ROUTES)) {
+    for (const target of route.targets) {
+        const group = getModelGroup(target.rewrite || '');
+        if (!group) continue;
+        let models = signatureGroupModels.get(group);
+        if (!models) {
+            models = new Set();
+            signatureGroupModels.set(group, models);
+        }
+        models.add(modelName);
+    }
+}
+const SIGNATURE_GROUP_ROUTES = Object.freeze(Object.assign(Object.create(null), Object.fromEntries(
+    [...signatureGroupModels].map(([group, models]) => [group, [...models]])
+)));
+
+const LOG_DIR = path.join(__dirname, 'logs', 'requests');
+const LOG_RETENTION_DAYS = 90;
+const DAY_MS = 24 * 60 * 60 * 1000;
+const LOG_CLEANUP_BATCH_SIZE = 50;
+const LOG_VERBOSE = process.env.LOG_VERBOSE === '1';
+const LOG_FLUSH_INTERVAL_MS = 50;
+const LOG_FLUSH_BATCH_SIZE = 256;
+const LOG_STREAM_HIGH_WATER_MARK = 1 << 20;
+const MAX_PENDING_LOG_ENTRIES = 5000;
+const RESPONSE_PREVIEW_LIMIT = LOG_VERBOSE ? 2000 : 500;
+const PREALLOC_RESPONSE_BODY_LIMIT = 8 * 1024 * 1024;
+const STICKY_ROUTE_TTL_MS = 7 * 24 * 60 * 60 * 1000;
+const STICKY_CLEANUP_MS = 10 * 60 * 1000;
+const MAX_STICKY_KEYS = 500;
+const TARGET_COOLDOWN_CLEANUP_MS = 10 * 1000;
+const MODEL_HEALTH_TTL_MS = 2 * 60 * 60 * 1000;
+const MODEL_HEALTH_CLEANUP_MS = 10 * 60 * 1000;
+const MAX_MODEL_HEALTH_KEYS = 5000;
+const RETRYABLE_ROUTE_ACTIONS = new Set(['auth', 'transient']);
+// TTL/冷却/健康度只需要粗粒度时间：每 50ms 刷新一次，路由热路径直接读变量；
+// 请求耗时等需要精确值的地方仍调用 Date.now()
+const COARSE_CLOCK_INTERVAL_MS = 50;
+let coarseNow = Date.now();
+setInterval(() => {
+    coarseNow = Date.now();
+}, COARSE_CLOCK_INTERVAL_MS).unref();
+// 刷新时先删后插，Map 的迭代顺序即 expiresAt 升序（TTL 固定），淘汰和清理都从头部开始
+const stickyRoutes = new Map();
+const targetCooldowns = new Map();
+// 与 stickyRoutes 相同：更新时先删后插，迭代顺序即 updatedAt 升序
+const modelHealth = new Map();
+const regexCache = new Map();
+
+// 确保日志目录存在
+if (!fs.existsSync(LOG_DIR)) {
+    fs.mkdirSync(LOG_DIR, { recursive: true });
+}
+
+// 获取当天日志文件路径（按 UTC 日期，与 toISOString 一致）；同一天内复用已拼好的路径
+let logFileDay = -1;
+let logFilePath = '';
+
+function getLogFile() {
+    const day = Math.floor(Date.now() / DAY_MS);
+    if (day !== logFileDay) {
+        logFileDay = day;
+        logFilePath = path.join(LOG_DIR, `${new Date(day * DAY_MS).toISOString().slice(0, 10)}.jsonl`);
+    }
+    return logFilePath;
+}
+
+// 当天日志文件保持一个追加写入流，跨天时切换到新文件
+let logStream = null;
+let logStreamFile = null;
+
+function getLogStream(logFile = getLogFile()) {
+    if (logStream && logStreamFile === logFile) return logStream;
+    if (logStream) logStream.end();
+    const stream = fs.createWriteStream(logFile, { flags: 'a', highWaterMark: LOG_STREAM_HIGH_WATER_MARK });
+    stream.on('error', (err) => {
+        console.error('Failed to write log:', err.message);
+        // 出错的流不再复用，下一条日志重新打开
+        if (logStream === stream) {
+            logStream = null;
+            logStreamFile = null;
+        }
+    });
+    logStream = stream;
+    logStreamFile = logFile;
+    return stream;
+}
+
+// 日志先入队，定时（或攒满一批时在下一轮事件循环）批量序列化后一次写入，响应结束路径上不做 JSON.stringify；
+// 写入流积压（磁盘跟不上）时等 drain 再写，期间日志留在队列里；队列满时丢弃并计数，下次落盘时报告
+let pendingLogEntries = [];
+let pendingLogFile = null;
+let logFlushTimer = null;
+let logFlushImmediate = false;
+let logDrainStream = null;
+let droppedLogEntries = 0;
+
+// 写入日志
+function writeLog(logEntry) {
+    const logFile = getLogFile();
+    if (pendingLogFile !== null && pendingLogFile !== logFile) flushLogs(true);
+    if (pendingLogEntries.length >= MAX_PENDING_LOG_ENTRIES) {
+        droppedLogEntries++;
+        return;
+    }
+    pendingLogFile = logFile;
+    pendingLogEntries.push(logEntry);
+    scheduleLogFlush();
+}
+
+function scheduleLogFlush() {
+    const urgent = pendingLogEntries.length >= LOG_FLUSH_BATCH_SIZE;
+    if (logFlushTimer && (!urgent || logFlushImmediate)) return;
+    cancelLogFlush();
+    logFlushImmediate = urgent;
+    logFlushTimer = urgent ? setImmediate(flushLogs) : setTimeout(flushLogs, LOG_FLUSH_INTERVAL_MS);
+}
+
+function cancelLogFlush() {
+    if (!logFlushTimer) return;
+    if (logFlushImmediate) clearImmediate(logFlushTimer);
+    else clearTimeout(logFlushTimer);
+    logFlushTimer = null;
+    logFlushImmediate = false;
+}
+
+function flushLogs(force = false) {
+    cancelLogFlush();
+    if (droppedLogEntries > 0) {
+        console.error(`Dropped ${droppedLogEntries} log entries: log queue full`);
+        droppedLogEntries = 0;
+    }
+    if (!pendingLogEntries.length) return;
+    const stream = getLogStream(pendingLogFile);
+    if (!force && stream.writableNeedDrain) {
+        if (logDrainStream !== stream) {
+            logDrainStream = stream;
+            stream.once('drain', () => {
+                if (logDrainStream === stream) logDrainStream = null;
+                flushLogs();
+            });
+        }
+        return;
+    }
+    const batch = pendingLogEntries;
+    pendingLogEntries = [];
+    pendingLogFile = null;
+    let lines = '';
+    for (const entry of batch) lines += JSON.stringify(entry) + '\n';
+    stream.write(lines);
+}
+
+// pm2 停止/重启时先把队列里的日志落盘再退出
+for (const signal of ['SIGINT', 'SIGTERM']) {
+    process.once(signal, () => {
+        flushLogs(true);
+        if (logStream) logStream.end(() => process.exit(0));
+        else process.exit(0);
+    });
+}
+
+// 清理过期日志：逐个 stat/unlink，每处理一批让出事件循环，避免目录很大时影响请求延迟
+async function cleanOldLogs() {
+    const cutoff = Date.now() - LOG_RETENTION_DAYS * 24 * 60 * 60 * 1000;
+    let processed = 0;
+    try {
+        const dir = await fs.promises.opendir(LOG_DIR);
+        for await (const dirent of dir) {
+            if (!dirent.name.endsWith('.jsonl')) continue;
+            const filePath = path.join(LOG_DIR, dirent.name);
+            try {
+                const stats = await fs.promises.stat(filePath);
+                if (stats.mtimeMs < cutoff) {
+                    await fs.promises.unlink(filePath);
+                    console.log(`🗑️ Cleaned old log: ${dirent.name}`);
+                }
+            } catch (err) {
+                // 文件可能已被并发删除，忽略
+            }
+            if (++processed % LOG_CLEANUP_BATCH_SIZE === 0) {
+                await new Promise(setImmediate);
+            }
+        }
+    } catch (err) {
+        // 日志目录不可读时跳过本轮清理
+    }
+}
+
+// 启动时清理一次，之后每天清理
+cleanOldLogs();
+setInterval(cleanOldLogs, 24 * 60 * 60 * 1000);
+setInterval(() => {
+    const now = Date.now();
+    for (const [key, value] of stickyRoutes) {
+        if (value.expiresAt > now) break;
+        deleteStickyRoute(key, value);
+    }
+}, STICKY_CLEANUP_MS);
+setInterval(() => {
+    const now = Date.now();
+    for (const [key, value] of targetCooldowns.entries()) {
+        if (value.expiresAt <= now) targetCooldowns.delete(key);
+    }
+}, TARGET_COOLDOWN_CLEANUP_MS);
+
+function cleanupModelHealth() {
+    const now = Date.now();
+    for (const [key, value] of modelHealth) {
+        if ((value.updatedAt || 0) + MODEL_HEALTH_TTL_MS > now) break;
+        modelHealth.delete(key);
+    }
+}
+
+setInterval(cleanupModelHealth, MODEL_HEALTH_CLEANUP_MS);
+
+// 路由规则里的正则都来自静态配置，编译一次后复用；非法 pattern 缓存为 null
+function getCachedRegex(pattern, flags = '') {
+    const key = `${flags}/${pattern}`;
+    if (regexCache.has(key)) return regexCache.get(key);
+    let regex = null;
+    try {
+        regex = new RegExp(pattern, flags);
+    } catch (error) {
+        regex = null;
+    }
+    regexCache.set(key, regex);
+    return regex;
+}
+
+function normalizeScalar(value) {
+    if (typeof value === 'string') {
+        const trimmed = value.trim();
+        if (trimmed.length === 0) return '';
+        const lower = trimmed.toLowerCase();
+        if (lower === 'true') return true;
+        if (lower === 'false') return false;
+        if (/^-?\d+(\.\d+)?$/.test(trimmed)) {
+            const num = Number(trimmed);
+            if (Number.isFinite(num)) return num;
+        }
+        return trimmed;
+    }
+    return value;
+}
+
+function toFiniteNumber(value) {
+    const normalized = normalizeScalar(value);
+    if (typeof normalized === 'number' && Number.isFinite(normalized)) return normalized;
+    return null;
+}
+
+function extractMessageTextLength(content, limit = Infinity) {
+    if (typeof content === 'string') return content.length;
+    if (!Array.isArray(content)) return 0;
+    let total = 0;
+    for (const block of content) {
+        if (total >= limit) break;
+        if (typeof block === 'string') {
+            total += block.length;
+            continue;
+        }
+        if (!block || typeof block !== 'object') continue;
+        if (typeof block.text === 'string') total += block.text.length;
+        if (typeof block.input_text === 'string') total += block.input_text.length;
+    }
+    return total;
+}
+
+function extractMessageText(content, limit = Infinity) {
+    if (typeof content === 'string') return content;
+    if (!Array.isArray(content)) return '';
+    let text = '';
+    for (const block of content) {
+        if (typeof block === 'string') { text += block; }
+        else if (block && typeof block === 'object') {
+            if (typeof block.text === 'string') text += block.text;
+            if (typeof block.input_text === 'string') text += block.input_text;
+        }
+        if (text.length >= limit) break;
+    }
+    return text;
+}
+
+const CODE_CONTEXT_RE = /```|import\s+|require\s*\(|from\s+\S+\s+import|class\s+\w+|function\s+\w+|def\s+\w+/;
+const LAST_USER_TEXT_LIMIT = 2000;
+const CODE_CONTEXT_WINDOW = 5;
+
+// 一次遍历 messages 得到 prompt_chars / has_system_prompt / last_user_text / has_code_context，
+// 避免每个因子各自从头扫描一遍请求体。promptCharsLimit 有限时 prompt_chars 累计到该值即停止
+function scanRequestBody(body, promptCharsLimit = Infinity) {
+    const result = { promptChars: 0, hasSystemPrompt: false, lastUserText: '', hasCodeContext: false };
+    if (!body || typeof body !== 'object') return result;
+    if (typeof body.system === 'string') {
+        result.promptChars += body.system.length;
+        if (body.system.trim().length > 0) result.hasSystemPrompt = true;
+    } else if (Array.isArray(body.system)) {
+        if (body.system.length > 0) result.hasSystemPrompt = true;
+        for (const item of body.system) {
+            if (typeof item === 'string') result.promptChars += item.length;
+            if (item && typeof item === 'object' && typeof item.text === 'string') result.promptChars += item.text.length;
+        }
+    }
+    const messages = body.messages;
+    if (!Array.isArray(messages)) return result;
+    const codeStart = Math.max(0, messages.length - CODE_CONTEXT_WINDOW);
+    let lastUserIndex = -1;
+    for (let i = 0; i < messages.length; i++) {
+        const message = messages[i];
+        if (!message) continue;
+        if (message.role === 'system') result.hasSystemPrompt = true;
+        if (message.role === 'user') lastUserIndex = i;
+        if (typeof message !== 'object') continue;
+        if (result.promptChars < promptCharsLimit) {
+            result.promptChars += extractMessageTextLength(message.content, promptCharsLimit - result.promptChars);
+        }
+        if (i >= codeStart && !result.hasCodeContext) {
+            const text = extractMessageText(message.content);
+            if (text && CODE_CONTEXT_RE.test(text)) result.hasCodeContext = true;
+        }
+    }
+    if (lastUserIndex >= 0) {
+        result.lastUserText = extractMessageText(messages[lastUserIndex].content, LAST_USER_TEXT_LIMIT).slice(0, LAST_USER_TEXT_LIMIT);
+    }
+    return result;
+}
+
+// 每类工具名模式合并为一个正则，每个工具名每类只匹配一次
+const TOOL_CODING_RE = /^edit$|^write$|^notebookedit$|^apply_patch$|update|create|insert|replace|code/;
+const TOOL_READ_RE = /^read$|^glob$|^grep$|^find$|^search|list|query|fetch/;
+const TOOL_EXPLORE_RE = /^task$|^websearch$|^webfetch$|browse|crawl|research/;
+const TOOL_OPS_RE = /^bash$|^shell$|^terminal$|^exec_command$|^write_stdin$|git|deploy|pm2/;
+
+function classifyToolProfile(body) {
+    if (!body || !Array.isArray(body.tools) || body.tools.length === 0) return 'none';
+    const names = new Set();
+    for (const tool of body.tools) {
+        const nameCandidates = [
+            tool?.function?.name,
+            tool?.name,
+            tool?.type
+        ];
+        for (const candidate of nameCandidates) {
+            if (typeof candidate !== 'string') continue;
+            const normalized = candidate.trim().toLowerCase();
+            if (normalized) names.add(normalized);
+        }
+    }
+    if (names.size === 0) return 'none';
+    let hasCoding = false;
+    let hasRead = false;
+    let hasExplore = false;
+    let hasOps = false;
+    for (const name of names) {
+        if (!hasCoding && TOOL_CODING_RE.test(name)) hasCoding = true;
+        if (!hasRead && TOOL_READ_RE.test(name)) hasRead = true;
+        if (!hasExplore && TOOL_EXPLORE_RE.test(name)) hasExplore = true;
+        if (!hasOps && TOOL_OPS_RE.test(name)) hasOps = true;
+    }
+    const categories = [];
+    if (hasCoding) categories.push('coding');
+    if (hasRead && !hasCoding) categories.push('read');
+    if (hasExplore) categories.push('explore');
+    if (hasOps) categories.push('ops');
+    if (categories.length > 1) return 'multi';
+    if (categories.length === 1) return categories[0];
+    return 'none';
+}
+
+// 按优先级排列：文本同时命中多个类别时取靠前的类别
+const TASK_CATEGORY_PATTERNS = [
+    ['architecture', /(architect|architecture|system\s*design|scalability|technical\s*design|架构|系统设计|可扩展)/i],
+    ['code-review', /(review|audit|refactor|rewrite|debug|root\s*cause|排查|根因|代码审查|重构)/i],
+    ['visual-coding', /(frontend|ui|css|tailwind|responsive|animation|visual|前端|界面|样式|动画|视觉)/i],
+    ['coding', /(implement|write|fix|add|create|modify|code|bug|patch|script|函数|代码|修复|实现)/i],
+    ['explore', /(find|search|where|explain|what|how|lookup|research|trace|inspect|查找|搜索|解释|什么|如何)/i],
+    ['ops', /(deploy|restart|build|test|run|release|ci\/?cd|运维|部署|发布|重启|构建)/i]
+];
+// 所有类别合并成一个交替正则：未命中任何类别（最常见情况）时只扫描一遍文本
+const TASK_CATEGORY_ANY_RE = new RegExp(TASK_CATEGORY_PATTERNS.map(([, regex]) => regex.source).join('|'), 'i');
+const QUICK_CHAT_RE = /^(hi|hello|thanks|ok|hey|你好|谢谢|收到)$/;
+
+function classifyTaskCategory(text) {
+    if (typeof text !== 'string' || !text.trim()) return 'unknown';
+    const normalized = text.toLowerCase();
+    if (TASK_CATEGORY_ANY_RE.test(normalized)) {
+        for (const [category, regex] of TASK_CATEGORY_PATTERNS) {
+            if (regex.test(normalized)) return category;
+        }
+    }
+    const quick = normalized.trim();
+    if (quick.length < 20 && QUICK_CHAT_RE.test(quick)) return 'quick';
+    return 'unknown';
+}
+
+function classifySystemPromptType(body) {
+    if (!body || typeof body !== 'object') return [];
+    const tags = [];
+    let systemText = '';
+    if (typeof body.system === 'string') { systemText = body.system; }
+    else if (Array.isArray(body.system)) {
+        for (const item of body.system) {
+            if (typeof item === 'string') systemText += item;
+            else if (item && typeof item.text === 'string') systemText += item.text;
+        }
+    }
+    if (Array.isArray(body.messages)) {
+        for (const msg of body.messages) {
+            if (msg?.role === 'system') {
+                const c = msg.content;
+                if (typeof c === 'string') systemText += c;
+            }
+        }
+    }
+    if (!systemText) return tags;
+    const lower = systemText.toLowerCase();
+    if (lower.includes('plan mode') || lower.includes('plan_mode') || lower.includes('enterplanmode')) tags.push('plan_mode');
+    if (lower.includes('review') || lower.includes('audit') || lower.includes('code review')) tags.push('review');
+    if (systemText.length > 5000) tags.push('long');
+    if (systemText.length <= 500) tags.push('short');
+    return tags;
+}
+
+function buildModelRouterFactors(requestedModel, body, sessionKeyHash, promptCharsLimit = Infinity) {
+    const messagesCount = Array.isArray(body?.messages) ? body.messages.length : 0;
+    const toolsCount = Array.isArray(body?.tools) ? body.tools.length : 0;
+    const requested = typeof requestedModel === 'string' ? requestedModel : '';
+    const health = getModelHealth(modelHealthKey(sessionKeyHash, requested));
+    const systemPromptType = classifySystemPromptType(body);
+    const scan = scanRequestBody(body, promptCharsLimit);
+    return {
+        requested_model: requested || null,
+        messages_count: messagesCount,
+        conversation_depth: messagesCount,
+        tools_count: toolsCount,
+        has_thinking_signature: hasThinkingSignature(body),
+        has_system_prompt: scan.hasSystemPrompt,
+        prompt_chars: scan.promptChars,
+        failure_streak: health.failureStreak || 0,
+        success_streak: health.successStreak || 0,
+        last_user_text: scan.lastUserText,
+        task_category: classifyTaskCategory(scan.lastUserText),
+        tool_profile: classifyToolProfile(body),
+        has_code_context: scan.hasCodeContext,
+        system_prompt_type: systemPromptType,
+        system_prompt_tags: systemPromptType
+    };
+}
+
+const NUMERIC_COMPARATORS = {
+    '<=': (left, right) => left <= right,
+    '>=': (left, right) => left >= right,
+    '<': (left, right) => left < right,
+    '>': (left, right) => left > right,
+    '==': (left, right) => left === right,
+    '!=': (left, right) => left !== right
+};
+
+const NEVER_MATCH = () => false;
+const isConditionMatched = (item) => item.matched;
+
+// 规则条件在启动时编译成 factors => 评估结果；规则侧取值已在生成配置时按 normalizeScalar 归一化
+function compileModelRouterCondition(condition) {
+    const field = String(condition?.field || '').trim();
+    const op = String(condition?.op || '==').trim().toLowerCase();
+    const expected = condition?.value;
+    const normalizedExpected = condition?.normalized_value;
+
+    if (!field) {
+        return () => ({ field, op, expected, actual: null, matched: false, reason: 'missing_field_name' });
+    }
+
+    let test = NEVER_MATCH;
+    let staticReason = null;
+    let reasonFor = null;
+    switch (op) {
+        case 'exists':
+            test = (actual, hasField) => hasField && actual != null;
+            break;
+        case 'not_exists':
+            test = (actual, hasField) => !hasField || actual == null;
+            break;
+        case '==':
+            test = (actual, hasField) => hasField && normalizeScalar(actual) === normalizedExpected;
+            break;
+        case '!=':
+            test = (actual, hasField) => !hasField || normalizeScalar(actual) !== normalizedExpected;
+            break;
+        case '>':
+        case '>=':
+        case '<':
+        case '<=': {
+            if (typeof normalizedExpected !== 'number' || !Number.isFinite(normalizedExpected)) {
+                staticReason = 'non_numeric_compare';
+                break;
+            }
+            const compare = NUMERIC_COMPARATORS[op];
+            test = (actual) => {
+                const left = toFiniteNumber(actual);
+                return left != null && compare(left, normalizedExpected);
+            };
+            reasonFor = (actual) => (toFiniteNumber(actual) == null ? 'non_numeric_compare' : null);
+            break;
+        }
+        case 'in':
+        case 'not_in': {
+            const values = new Set(Array.isArray(normalizedExpected) ? normalizedExpected : []);
+            const wanted = op === 'in';
+            test = (actual) => values.has(normalizeScalar(actual)) === wanted;
+            break;
+        }
+        case 'contains':
+        case 'not_contains': {
+            const needle = String(expected ?? '');
+            const wanted = op === 'contains';
+            test = (actual) => {
+                let exists = false;
+                if (Array.isArray(actual)) {
+                    exists = actual.some((item) => normalizeScalar(item) === normalizedExpected);
+                } else if (typeof actual === 'string') {
+                    exists = actual.includes(needle);
+                }
+                return exists === wanted;
+            };
+            break;
+        }
+        case 'regex': {
+            if (typeof expected !== 'string') {
+                staticReason = 'regex_pattern_not_string';
+                break;
+            }
+            const regex = getCachedRegex(expected);
+            if (!regex) {
+                staticReason = 'invalid_regex';
+                break;
+            }
+            test = (actual) => regex.test(String(actual ?? ''));
+            break;
+        }
+        default:
+            staticReason = 'unsupported_op';
+            break;
+    }
+
+    return (factors) => {
+        const actual = factors[field];
+        const matched = test(actual, Object.prototype.hasOwnProperty.call(factors, field));
+        const reason = matched ? null : (reasonFor ? reasonFor(actual) : staticReason);
+        return { field, op, expected, actual, matched, reason };
+    };
+}
+
+// 因子为空（null/undefined）时该条件必定不成立
+function conditionRequiresValue(condition) {
+    const op = String(condition?.op || '==').trim().toLowerCase();
+    const expected = condition?.normalized_value;
+    switch (op) {
+        case 'exists':
+        case '>':
+        case '>=':
+        case '<':
+        case '<=':
+        case 'contains':
+            return true;
+        case '==':
+            return expected != null;
+        case 'in':
+            return Array.isArray(expected) && !expected.some((item) => item == null);
+        default:
+            return false;
+    }
+}
+
+function compileModelRouterRule(rule) {
+    const rawConditions = Array.isArray(rule?.when) ? rule.when : [];
+    const conditions = rawConditions.map(compileModelRouterCondition);
+    const mode = String(rule?.match || 'all').toLowerCase() === 'any' ? 'any' : 'all';
+    // all 模式下这些因子任一为空，规则就不可能命中
+    const requiredFields = new Set();
+    if (mode === 'all') {
+        for (const condition of rawConditions) {
+            const field = String(condition?.field || '').trim();
+            if (field && conditionRequiresValue(condition)) requiredFields.add(field);
+        }
+    }
+    return {
+        name: String(rule?.name || 'unnamed_rule'),
+        priority: Number(rule?.priority || 0),
+        target_model: String(rule?.target_model || '').trim(),
+        match: String(rule?.match || 'all'),
+        required_fields: [...requiredFields],
+        evaluate(factors) {
+            if (conditions.length === 0) {
+                return { matched: true, mode, conditions: [] };
+            }
+            const conditionResults = conditions.map((evaluateCondition) => evaluateCondition(factors));
+            const matched = mode === 'any'
+                ? conditionResults.some(isConditionMatched)
+                : conditionResults.every(isConditionMatched);
+            return { matched, mode, conditions: conditionResults };
+        }
+    };
+}
+
+// rules 配置在生成时已固定（且已按 priority 降序），启动时编译一次
+const COMPILED_RULES = (Array.isArray(MODEL_ROUTER_CONFIG?.rules) ? MODEL_ROUTER_CONFIG.rules : [])
+    .map(compileModelRouterRule);
+
+// 因子名 -> 依赖该因子非空的规则；请求中为空的因子对应的规则可以直接跳过
+const RULES_BY_FACTOR = new Map();
+for (const rule of COMPILED_RULES) {
+    for (const field of rule.required_fields) {
+        if (!RULES_BY_FACTOR.has(field)) RULES_BY_FACTOR.set(field, []);
+        RULES_BY_FACTOR.get(field).push(rule);
+    }
+}
+
+function collectUnreachableRules(factors) {
+    let unreachable = null;
+    for (const [field, rules] of RULES_BY_FACTOR) {
+        if (factors[field] != null) continue;
+        if (!unreachable) unreachable = new Set();
+        for (const rule of rules) unreachable.add(rule);
+    }
+    return unreachable;
+}
+
+const OP_THRESHOLD_RE = /^(<=|>=|<|>|==|!=)(\d+(?:\.\d+)?)$/;
+
+// 解析 "<op><number>" 形式的信号值，返回 factorVal => boolean
+function compileThreshold(value) {
+    const opMatch = OP_THRESHOLD_RE.exec(value);
+    if (!opMatch) return null;
+    const threshold = Number(opMatch[2]);
+    if (!Number.isFinite(threshold)) return null;
+    const compare = NUMERIC_COMPARATORS[opMatch[1]];
+    return (factorVal) => factorVal != null && compare(factorVal, threshold);
+}
+
+// 把 "type:value" 信号预编译成 factors => boolean，取值解析只在启动时做一次
+function compileCategorySignal(signal) {
+    if (typeof signal !== 'string') return NEVER_MATCH;
+    const colonIdx = signal.indexOf(':');
+    if (colonIdx < 0) return NEVER_MATCH;
+    const type = signal.slice(0, colonIdx).trim().toLowerCase();
+    const value = signal.slice(colonIdx + 1).trim();
+    const lowerValue = value.toLowerCase();
+    switch (type) {
+        case 'keyword': {
+            const regex = getCachedRegex(value, 'i');
+            if (!regex) return NEVER_MATCH;
+            return (factors) => {
+                const text = factors.last_user_text;
+                return typeof text === 'string' && text.length > 0 && regex.test(text);
+            };
+        }
+        case 'task_category':
+            return (factors) => String(factors.task_category || '').toLowerCase() === lowerValue;
+        case 'tool_profile':
+            return (factors) => String(factors.tool_profile || '').toLowerCase() === lowerValue;
+        case 'has_code_context':
+            return (factors) => String(!!factors.has_code_context) === lowerValue;
+        case 'system_prompt_type':
+        case 'system_tag':
+            return (factors) => (Array.isArray(factors.system_prompt_type)
+                ? factors.system_prompt_type.includes(value)
+                : Array.isArray(factors.system_prompt_tags) && factors.system_prompt_tags.includes(value));
+        case 'conversation_depth':
+        case 'messages_count':
+        case 'prompt_chars': {
+            const test = compileThreshold(value);
+            if (!test) return NEVER_MATCH;
+            const field = type === 'conversation_depth' ? 'messages_count' : type;
+            return (factors) => test(toFiniteNumber(factors[field]));
+        }
+        default:
+            return NEVER_MATCH;
+    }
+}
+
+function compileCategories(categories) {
+    if (!Array.isArray(categories)) return [];
+    return categories.map((cat) => ({
+        name: cat.name || 'unnamed',
+        target_model: cat.target_model || '',
+        signals: (Array.isArray(cat.signals) ? cat.signals : []).map((signal) => ({
+            signal,
+            test: compileCategorySignal(signal)
+        }))
+    }));
+}
+
+// categories 配置在生成时已固定，启动时编译一次
+const CATEGORY_MATCHERS = compileCategories(MODEL_ROUTER_CONFIG?.categories);
+
+function resolveModelViaCategories(factors, matchers) {
+    for (const cat of matchers) {
+        for (const { signal, test } of cat.signals) {
+            if (test(factors)) {
+                return {
+                    matched: true,
+                    category_name: cat.name,
+                    target_model: cat.target_model,
+                    matched_signal: signal
+                };
+            }
+        }
+    }
+    return { matched: false, category_name: null, target_model: null, matched_signal: null };
+}
+
+function resolveModelViaRouter(requestedModel, body, sessionKeyHash) {
+    const requested = typeof requestedModel === 'string' ? requestedModel : '';
+    const config = MODEL_ROUTER_CONFIG && typeof MODEL_ROUTER_CONFIG === 'object'
+        ? MODEL_ROUTER_CONFIG
+        : null;
+
+    if (!config?.enabled) {
+        return {
+            enabled: false,
+            activated: false,
+            shadow_only: false,
+            decision: 'disabled',
+            requested_model: requested || null,
+            suggested_model: requested || null,
+            resolved_model: requested || null,
+            applied: false,
+            hit_rule: null,
+            factors: null,
+            eval_trace: null
+        };
+    }
+
+    const activationModels = Array.isArray(config.activation_models) ? config.activation_models : [];
+    if (activationModels.length > 0 && !activationModels.includes(requested)) {
+        return {
+            enabled: true,
+            activated: false,
+            shadow_only: config.shadow_only === true,
+            decision: 'not_activated',
+            requested_model: requested || null,
+            suggested_model: requested || null,
+            resolved_model: requested || null,
+            applied: false,
+            hit_rule: null,
+            factors: config.log_factors ? buildModelRouterFactors(requested, body, sessionKeyHash) : null,
+            eval_trace: null
+        };
+    }
+
+    // 不记录 factors 时 prompt_chars 只用于阈值比较，按配置推导的上限提前结束统计
+    const promptCharsLimit = Number.isFinite(config.prompt_chars_limit) ? config.prompt_chars_limit : Infinity;
+    const factors = buildModelRouterFactors(requested, body, sessionKeyHash, promptCharsLimit);
+    const trace = [];
+    let hitRule = null;
+    let suggestedModel = requested;
+    let decision = 'no_rule';
+
+    // Categories routing (priority over threshold rules)
+    if (CATEGORY_MATCHERS.length > 0) {
+        const catResult = resolveModelViaCategories(factors, CATEGORY_MATCHERS);
+        if (catResult.matched && ROUTES[catResult.target_model] !== undefined) {
+            hitRule = {
+                name: `cat_${catResult.category_name}`,
+                priority: 0,
+                target_model: catResult.target_model,
+                match: 'category',
+                matched_signal: catResult.matched_signal
+            };
+            suggestedModel = catResult.target_model;
+            decision = `category_hit_${catResult.category_name}`;
+        }
+    }
+
+    // Threshold rules (fallback when no category matched)
+    // eval_trace 需要记录每条规则的评估结果，只有不记录时才跳过必不命中的规则
+    const unreachableRules = hitRule || config.log_factors ? null : collectUnreachableRules(factors);
+    if (!hitRule) { for (const rule of COMPILED_RULES) {
+        if (unreachableRules && unreachableRules.has(rule)) continue;
+        const targetModel = rule.target_model;
+        const ruleName = rule.name;
+        const priority = rule.priority;
+
+        if (!targetModel) {
+            trace.push({
+                rule: ruleName,
+                priority,
+                matched: false,
+                skipped: 'missing_target_model'
+            });
+            continue;
+        }
+        if (ROUTES[targetModel] === undefined) {
+            trace.push({
+                rule: ruleName,
+                priority,
+                matched: false,
+                skipped: 'target_model_not_found',
+                target_model: targetModel
+            });
+            continue;
+        }
+
+        const result = rule.evaluate(factors);
+        trace.push({
+            rule: ruleName,
+            priority,
+            target_model: targetModel,
+            match_mode: result.mode,
+            matched: result.matched,
+            conditions: result.conditions
+        });
+
+        if (result.matched) {
+            hitRule = {
+                name: ruleName,
+                priority,
+                target_model: targetModel,
+                match: rule.match
+            };
+            suggestedModel = targetModel;
+            decision = `rule_hit_${ruleName}`;
+            break;
+        }
+    }
+
+    if (!hitRule) {
+        const defaultModel = String(config.default_model || '').trim();
+        if (defaultModel) {
+            if (ROUTES[defaultModel] !== undefined) {
+                suggestedModel = defaultModel;
+                decision = 'default_model';
+            } else {
+                decision = 'default_model_not_found';
+                trace.push({
+                    rule: '__default_model__',
+                    matched: false,
+                    skipped: 'default_model_not_found',
+                    target_model: defaultModel
+                });
+            }
+        }
+    }
+    } // end if (!hitRule) — categories guard
+
+    const shadowOnly = config.shadow_only === true;
+    const applied = !shadowOnly && suggestedModel !== requested;
+    const resolvedModel = applied ? suggestedModel : requested;
+
+    return {
+        enabled: true,
+        activated: true,
+        shadow_only: shadowOnly,
+        decision,
+        requested_model: requested || null,
+        suggested_model: suggestedModel || null,
+        resolved_model: resolvedModel || null,
+        applied,
+        hit_rule: hitRule,
+        factors: config.log_factors ? factors : null,
+        eval_trace: config.log_factors ? trace : null
+    };
+}
+
+// 从 SSE 流中提取 usage 信息：取最后一个带 usage 的 data 行。
+// 从末尾往前只定位含 "usage" 的行再解析，不必切分、解析整个流
+function extractUsageFromSSE(chunks) {
+    let idx = chunks.lastIndexOf('"usage"');
+    while (idx >= 0) {
+        const lineStart = chunks.lastIndexOf('\n', idx) + 1;
+        let lineEnd = chunks.indexOf('\n', idx);
+        if (lineEnd < 0) lineEnd = chunks.length;
+        if (chunks.startsWith('data: ', lineStart)) {
+            try {
+                const data = JSON.parse(chunks.slice(lineStart + 6, lineEnd));
+                if (data.usage) return data.usage;
+            } catch (e) {}
+        }
+        idx = lineStart > 0 ? chunks.lastIndexOf('"usage"', lineStart - 1) : -1;
+    }
+    return null;
+}
+
+// 非 SSE 的 JSON 响应体在结束时只解析一次，解析失败或非 JSON 返回 null
+function parseJsonResponseBody(contentType, body) {
+    if (!contentType.includes('application/json') || typeof body !== 'string') return null;
+    try {
+        return JSON.parse(body);
+    } catch (e) {
+        return null;
+    }
+}
+
+function extractUsageFromJSON(body, parsedBody = parseJsonResponseBody('application/json', body)) {
+    return parsedBody?.usage || null;
+}
+
+function getContentEncoding(proxyHeaders) {
+    const headerValue = proxyHeaders?.['content-encoding'] ?? proxyHeaders?.['Content-Encoding'] ?? '';
+    return String(headerValue || '')
+        .split(',')
+        .map((part) => part.trim().toLowerCase())
+        .find((part) => part.length > 0) || '';
+}
+
+// 解压放到 libuv 线程池执行，大响应解压时不阻塞其他请求
+const RESPONSE_DECOMPRESSORS = new Map([
+    ['gzip', promisify(zlib.gunzip)],
+    ['x-gzip', promisify(zlib.gunzip)],
+    ['br', promisify(zlib.brotliDecompress)],
+    ['deflate', promisify(zlib.inflate)]
+]);
+
+// SSE 按分片流式解压，与未压缩的 SSE 一样边收边扫描 usage，不必攒齐整个流
+const RESPONSE_STREAM_DECOMPRESSORS = new Map([
+    ['gzip', zlib.createGunzip],
+    ['x-gzip', zlib.createGunzip],
+    ['br', zlib.createBrotliDecompress],
+    ['deflate', zlib.createInflate]
+]);
+
+async function decodeResponseBody(rawBodyBuffer, proxyHeaders) {
+    if (!Buffer.isBuffer(rawBodyBuffer) || rawBodyBuffer.length === 0) {
+        return {
+            bodyText: '',
+            decodedFromEncoding: null,
+            decodeError: null
+        };
+    }
+
+    const encoding = getContentEncoding(proxyHeaders);
+    const decompress = RESPONSE_DECOMPRESSORS.get(encoding);
+    if (!decompress) {
+        return {
+            bodyText: rawBodyBuffer.toString('utf-8'),
+            decodedFromEncoding: null,
+            decodeError: null
+        };
+    }
+
+    try {
+        const decoded = await decompress(rawBodyBuffer);
+        return {
+            bodyText: decoded.toString('utf-8'),
+            decodedFromEncoding: encoding,
+            decodeError: null
+        };
+    } catch (error) {
+        return {
+            bodyText: rawBodyBuffer.toString('utf-8'),
+            decodedFromEncoding: null,
+            decodeError: error?.message || 'decode_failed'
+        };
+    }
+}
+
+function parseErrorSummary(contentType, body, parsedBody = parseJsonResponseBody(contentType, body)) {
+    const segments = [];
+    const err = parsedBody?.error ?? parsedBody;
+    if (typeof err === 'string') {
+        segments.push(err);
+    } else if (err && typeof err === 'object') {
+        const fields = ['message', 'code', 'type', 'status', 'reason'];
+        for (const field of fields) {
+            if (typeof err[field] === 'string') segments.push(err[field]);
+        }
+        if (Array.isArray(err.details)) {
+            for (const detail of err.details) {
+                if (detail && typeof detail.reason === 'string') segments.push(detail.reason);
+                if (typeof detail?.domain === 'string') segments.push(detail.domain);
+            }
+        }
+    }
+    if (segments.length === 0 && typeof body === 'string' && body.length > 0) {
+        segments.push(body.slice(0, RESPONSE_PREVIEW_LIMIT));
+    }
+    return segments.join(' ').toLowerCase();
+}
+
+// 错误摘要（已转小写）中的关键短语，每类合并为一个正则只扫描一遍
+const AUTH_ERROR_RE = /auth_unavailable|auth_not_found/;
+const VALIDATION_ERROR_RE = /validation_required|verify your account|validation_url/;
+const QUOTA_ERROR_RE = /insufficient_quota|quota exceeded|quote_exceeded|subscription quota|quota limit|quota refresh/;
+
+function classifyResponse(statusCode, contentType, body, hasThinkingSignature, parsedBody) {
+    if (statusCode >= 200 && statusCode < 300) {
+        return { kind: 'success', clearSticky: false, cooldownMs: 0 };
+    }
+
+    const summary = parseErrorSummary(contentType, body, parsedBody);
+    const isAuthError = statusCode === 401 || statusCode === 403 || AUTH_ERROR_RE.test(summary);
+    if (isAuthError) {
+        let cooldownMs = AUTH_COOLDOWN_MS;
+        if (statusCode === 403 && VALIDATION_ERROR_RE.test(summary)) {
+            cooldownMs = VALIDATION_COOLDOWN_MS;
+        } else if (QUOTA_ERROR_RE.test(summary)) {
+            cooldownMs = QUOTA_COOLDOWN_MS;
+        }
+        return { kind: 'auth', clearSticky: true, cooldownMs };
+    }
+
+    const isSignatureError = hasThinkingSignature &&
+        summary.includes('signature') &&
+        (statusCode === 400 || statusCode === 422 || statusCode === 500);
+    if (isSignatureError) {
+        return { kind: 'signature', clearSticky: true, cooldownMs: SIGNATURE_COOLDOWN_MS };
+    }
+
+    if ([408, 429, 500, 502, 503, 504].includes(statusCode)) {
+        const cooldownMs = (statusCode === 429 || statusCode === 503)
+            ? TRANSIENT_HEAVY_COOLDOWN_MS
+            : TRANSIENT_COOLDOWN_MS;
+        return { kind: 'transient', clearSticky: true, cooldownMs };
+    }
+
+    if (statusCode === 400 || statusCode === 422) {
+        return { kind: 'client', clearSticky: false, cooldownMs: 0 };
+    }
+
+    return {
+        kind: 'other',
+        clearSticky: statusCode >= 500,
+        cooldownMs: statusCode >= 500 ? TRANSIENT_COOLDOWN_MS : 0
+    };
+}
+
+function maskSecret(value) {
+    if (typeof value !== 'string') return '***';
+    if (value.length <= 10) return '***';
+    return `${value.slice(0, 6)}...${value.slice(-4)}`;
+}
+
+const SENSITIVE_HEADERS = new Set([
+    'authorization', 'x-api-key', 'api-key', 'proxy-authorization', 'cookie', 'set-cookie'
+]);
+
+function sanitizeHeaders(headers) {
+    const out = {};
+    if (!headers) return out;
+    for (const rawKey in headers) {
+        const rawValue = headers[rawKey];
+        if (SENSITIVE_HEADERS.has(rawKey.toLowerCase())) {
+            out[rawKey] = Array.isArray(rawValue) ? rawValue.map(maskSecret) : maskSecret(rawValue);
+        } else {
+            out[rawKey] = rawValue;
+        }
+    }
+    return out;
+}
+
+function summarizeRequestBody(body) {
+    if (body == null) return null;
+    if (typeof body !== 'object') return body;
+    const messages = Array.isArray(body.messages) ? body.messages : [];
+    const modelValue = typeof body.model === 'string' ? body.model : null;
+    // 按角色计数，长对话的摘要大小保持不变
+    const roleCounts = {};
+    for (const message of messages) {
+        const role = message?.role || 'null';
+        roleCounts[role] = (roleCounts[role] || 0) + 1;
+    }
+    const summary = {
+        model: modelValue,
+        max_tokens: typeof body.max_tokens === 'number' ? body.max_tokens : null,
+        stream: body.stream === true,
+        temperature: typeof body.temperature === 'number' ? body.temperature : null,
+        messages_count: messages.length,
+        message_role_counts: roleCounts,
+        has_thinking_signature: hasThinkingSignature(body),
+        tool_count: Array.isArray(body.tools) ? body.tools.length : 0,
+        system_count: Array.isArray(body.system) ? body.system.length : 0
+    };
+    if (body.metadata && typeof body.metadata === 'object') {
+        summary.metadata_keys = Object.keys(body.metadata).sort();
+        if (typeof body.metadata.user_id === 'string') {
+            summary.metadata_user_hash = hashSessionKey(body.metadata.user_id);
+        }
+    }
+    return summary;
+}
+
+function shouldNormalizeErrorMessage(message) {
+    if (typeof message !== 'string' || message.length === 0) return false;
+    const hasGzipMagic = message.length >= 2 &&
+        message.charCodeAt(0) === 0x1f &&
+        message.charCodeAt(1) === 0x8b;
+    if (hasGzipMagic) return true;
+    // 单次扫描统计控制字符（不含 \t \n \r）和替换字符 U+FFFD，任一达到 3 个即可返回
+    let controlChars = 0;
+    let replacementChars = 0;
+    for (let i = 0; i < message.length; i++) {
+        const code = message.charCodeAt(i);
+        if (code <= 0x1f) {
+            if (code !== 0x09 && code !== 0x0a && code !== 0x0d && ++controlChars >= 3) return true;
+        } else if (code === 0xfffd && ++replacementChars >= 3) {
+            return true;
+        }
+    }
+    return false;
+}
+
+// 转发给客户端的响应头：去掉 content-length（正文可能被改写），已解压时去掉 content-encoding
+function copyResponseHeaders(headers, dropContentEncoding) {
+    const copied = {};
+    for (const name in headers) {
+        const lowerName = name.toLowerCase();
+        if (lowerName === 'content-length') continue;
+        if (dropContentEncoding && lowerName === 'content-encoding') continue;
+        copied[name] = headers[name];
+    }
+    return copied;
+}
+
+function maybeNormalizeJsonErrorBody(contentType, responseBody, parsedBody) {
+    if (!contentType.includes('application/json') || typeof responseBody !== 'string') {
+        return responseBody;
+    }
+    // 没有 error.message 字段的响应体（绝大多数成功响应）不必解析
+    if (!responseBody.includes('"error"') || !responseBody.includes('"message"')) {
+        return responseBody;
+    }
+    const payload = parsedBody === undefined ? parseJsonResponseBody(contentType, responseBody) : parsedBody;
+    if (!payload?.error || typeof payload.error !== 'object') {
+        return responseBody;
+    }
+    const message = payload.error.message;
+    if (!shouldNormalizeErrorMessage(message)) {
+        return responseBody;
+    }
+    // 只有确实需要改写时才重新序列化
+    const code = typeof payload.error.code === 'string' ? payload.error.code : null;
+    payload.error.message = code === 'insufficient_quota'
+        ? 'upstream quota exhausted; please switch account/key or wait for quota reset'
+        : 'upstream returned unreadable compressed error details';
+    return JSON.stringify(payload);
+}
+
+// target 对象来自生成时固定的 ROUTES：身份串和各 model 的冷却键以不可枚举属性挂在 target 上，
+// 热路径上只是属性读取；不可枚举，日志序列化 target 时不会带出
+function pinTargetKeys(target) {
+    const identity = `${target.instance}::${target.target}::${target.rewrite}`;
+    Object.defineProperty(target, '_identity', { value: identity });
+    Object.defineProperty(target, '_cooldownKeys', { value: Object.create(null) });
+    return identity;
+}
+
+function targetIdentity(target) {
+    if (!target) return '';
+    if (typeof target !== 'object') return `${target.instance}::${target.target}::${target.rewrite}`;
+    const identity = target._identity;
+    return identity !== undefined ? identity : pinTargetKeys(target);
+}
+
+for (const route of Object.values(ROUTES)) {
+    for (const target of route.targets) targetIdentity(target);
+}
+
+// 单个请求最多尝试 1 + MAX_TARGET_RETRIES 个 target，用小数组记录身份串即可，
+// 判重是几次字符串比较，日志里直接引用这个数组
+function ensureTriedTargets(req) {
+    if (!req._triedTargets) {
+        req._triedTargets = [];
+    }
+    return req._triedTargets;
+}
+
+function markTriedTarget(req, target) {
+    const key = targetIdentity(target);
+    if (!key) return;
+    const tried = ensureTriedTargets(req);
+    if (!tried.includes(key)) tried.push(key);
+}
+
+function hasTriedTarget(req, target) {
+    const key = targetIdentity(target);
+    if (!key || !req._triedTargets) return false;
+    return req._triedTargets.includes(key);
+}
+
+function toPositiveInt(value) {
+    const num = Number(value);
+    if (!Number.isFinite(num)) return null;
+    const asInt = Math.floor(num);
+    return asInt > 0 ? asInt : null;
+}
+
+function mergeCommaHeader(existingValue, appendValue) {
+    if (typeof appendValue !== 'string' || !appendValue.trim()) return existingValue;
+    const existingParts = String(existingValue || '')
+        .split(',')
+        .map((part) => part.trim())
+        .filter((part) => part.length > 0);
+    const existingSet = new Set(existingParts.map((part) => part.toLowerCase()));
+    const extraParts = appendValue
+        .split(',')
+        .map((part) => part.trim())
+        .filter((part) => part.length > 0);
+    for (const part of extraParts) {
+        const normalized = part.toLowerCase();
+        if (!existingSet.has(normalized)) {
+            existingParts.push(part);
+            existingSet.add(normalized);
+        }
+    }
+    return existingParts.join(',');
+}
+
+function summarizeTargetParams(params) {
+    if (!params || typeof params !== 'object' || Array.isArray(params)) return null;
+    const summary = {};
+    if (typeof params.reasoning_effort === 'string' && params.reasoning_effort.trim()) {
+        summary.reasoning_effort = params.reasoning_effort.trim();
+    }
+    const thinkingBudgetMax = toPositiveInt(params.thinking_budget_max);
+    if (thinkingBudgetMax) {
+        summary.thinking_budget_max = thinkingBudgetMax;
+    }
+    const maxTokensMax = toPositiveInt(params.max_tokens_max);
+    if (maxTokensMax) {
+        summary.max_tokens_max = maxTokensMax;
+    }
+    const maxTokensDefault = toPositiveInt(params.max_tokens_default);
+    if (maxTokensDefault) {
+        summary.max_tokens_default = maxTokensDefault;
+    }
+    if (typeof params.thinking_level === 'string' && params.thinking_level.trim()) {
+        summary.thinking_level = params.thinking_level.trim();
+    }
+    if (typeof params.anthropic_beta === 'string' && params.anthropic_beta.trim()) {
+        summary.anthropic_beta = params.anthropic_beta.trim();
+    }
+    if (params.extra_headers && typeof params.extra_headers === 'object' && !Array.isArray(params.extra_headers)) {
+        summary.extra_header_keys = Object.keys(params.extra_headers)
+            .map((key) => String(key).toLowerCase())
+            .sort();
+    }
+    return Object.keys(summary).length > 0 ? summary : null;
+}
+
+// 转发过程中会被改写的请求头：http-proxy 的 xfwd 追加 x-forwarded-*，DELETE/OPTIONS 会补 content-length
+const PROXY_MUTATED_HEADERS = [
+    'x-forwarded-for', 'x-forwarded-port', 'x-forwarded-proto', 'x-forwarded-host',
+    'content-length', 'transfer-encoding'
+];
+
+// 改写请求头前记下原值（undefined 表示原本不存在），重试时按记录还原，
+// 不必在每个请求入口整份复制 headers
+function setForwardHeader(req, key, value) {
+    if (!Object.prototype.hasOwnProperty.call(req._headerUndo, key)) {
+        req._headerUndo[key] = req.headers[key];
+    }
+    req.headers[key] = value;
+}
+
+function restoreForwardHeaders(req) {
+    const undo = req._headerUndo;
+    for (const key in undo) {
+        const value = undo[key];
+        if (value === undefined) {
+            delete req.headers[key];
+        } else {
+            req.headers[key] = value;
+        }
+    }
+}
+
+function applyTargetHeaders(req, target) {
+    if (req._headerUndo) {
+        // 重试：撤销上一次转发对 req.headers 的改动（目标 header、content-length、x-forwarded-*）
+        restoreForwardHeaders(req);
+    } else {
+        req._headerUndo = Object.create(null);
+        for (const key of PROXY_MUTATED_HEADERS) {
+            req._headerUndo[key] = req.headers[key];
+        }
+    }
+    const params = target?.params;
+    if (!params || typeof params !== 'object' || Array.isArray(params)) return;
+
+    if (typeof params.anthropic_beta === 'string' && params.anthropic_beta.trim()) {
+        setForwardHeader(req, 'anthropic-beta', mergeCommaHeader(req.headers['anthropic-beta'], params.anthropic_beta));
+    }
+
+    if (params.extra_headers && typeof params.extra_headers === 'object' && !Array.isArray(params.extra_headers)) {
+        for (const [rawKey, rawValue] of Object.entries(params.extra_headers)) {
+            const key = String(rawKey || '').trim();
+            if (!key) continue;
+            const lowerKey = key.toLowerCase();
+            if (lowerKey === 'content-length' || lowerKey === 'host') continue;
+            if (rawValue == null) continue;
+            setForwardHeader(req, key, String(rawValue));
+        }
+    }
+}
+
+function applyTargetParamsToPayload(payload, target) {
+    const params = target?.params;
+    if (!params || typeof params !== 'object' || Array.isArray(params)) return payload;
+
+    if (typeof params.reasoning_effort === 'string' && params.reasoning_effort.trim()) {
+        payload.reasoning_effort = params.reasoning_effort.trim();
+    }
+
+    const thinkingBudgetMax = toPositiveInt(params.thinking_budget_max);
+    if (thinkingBudgetMax && payload.thinking && typeof payload.thinking === 'object' && !Array.isArray(payload.thinking)) {
+        const currentBudget = toPositiveInt(payload.thinking.budget_tokens);
+        if (currentBudget && currentBudget > thinkingBudgetMax) {
+            payload.thinking.budget_tokens = thinkingBudgetMax;
+        }
+    }
+
+    const initialMaxTokens = toPositiveInt(payload.max_tokens);
+    const maxTokensMax = toPositiveInt(params.max_tokens_max);
+    if (maxTokensMax && initialMaxTokens && initialMaxTokens > maxTokensMax) {
+        payload.max_tokens = maxTokensMax;
+    }
+
+    const maxTokensDefault = toPositiveInt(params.max_tokens_default);
+    if (maxTokensDefault && !initialMaxTokens) {
+        payload.max_tokens = maxTokensDefault;
+    }
+
+    const finalMaxTokens = toPositiveInt(payload.max_tokens);
+    if (finalMaxTokens && payload.thinking && typeof payload.thinking === 'object' && !Array.isArray(payload.thinking)) {
+        const currentBudget = toPositiveInt(payload.thinking.budget_tokens);
+        if (currentBudget && currentBudget >= finalMaxTokens) {
+            if (finalMaxTokens <= 1) {
+                delete payload.thinking.budget_tokens;
+            } else {
+                payload.thinking.budget_tokens = finalMaxTokens - 1;
+            }
+        }
+    }
+
+    return payload;
+}
+
+function cloneRequestPayloadForTarget(req, target) {
+    if (!req._requestBody || typeof req._requestBody !== 'object') {
+        if (Buffer.isBuffer(req._rawBodyBuffer)) return req._rawBodyBuffer;
+        return Buffer.from('');
+    }
+    const body = req._requestBody;
+    let rewrittenModel = body.model;
+    if (typeof req._model === 'string' && req._model.length > 0) {
+        rewrittenModel = (target?.rewrite && target.rewrite !== req._model)
+            ? target.rewrite
+            : req._model;
+        // Append thinking_level suffix so cliproxy uses this level instead of
+        // deriving one from the client's budget_tokens (which may map to an
+        // unsupported level like "xhigh" for models that only accept "low"/"high").
+        const thinkingLevel = target?.params?.thinking_level;
+        if (typeof thinkingLevel === 'string' && thinkingLevel.trim()) {
+            // Only append if the model name doesn't already have a suffix
+            if (!rewrittenModel.includes('(')) {
+                rewrittenModel = rewrittenModel + '(' + thinkingLevel.trim() + ')';
+            }
+        }
+    }
+    const params = target?.params;
+    // 只要 params 是对象，applyTargetParamsToPayload 就可能按 max_tokens 收紧 thinking 预算
+    const hasParams = !!params && typeof params === 'object' && !Array.isArray(params);
+    const stripsMetadata = target?.provider === 'minimax' && Object.prototype.hasOwnProperty.call(body, 'metadata');
+    // 目标不改写任何字段时直接转发原始请求体，省掉一次序列化
+    if (rewrittenModel === body.model && !hasParams && !stripsMetadata && Buffer.isBuffer(req._rawBodyBuffer)) {
+        return req._rawBodyBuffer;
+    }
+    // 改写结果只取决于模型名、影响请求体的 params 和是否剥离 metadata；
+    // 重试到改写相同的另一个目标时直接复用上次序列化好的请求体
+    const cacheKey = rewrittenModel + '\u0000'
+        + (hasParams ? JSON.stringify(summarizeTargetParams(params)) : '') + '\u0000'
+        + (stripsMetadata ? '1' : '0');
+    if (!req._forwardBodyCache) {
+        req._forwardBodyCache = new Map();
+    } else {
+        const cached = req._forwardBodyCache.get(cacheKey);
+        if (cached) return cached;
+    }
+    // 只改写顶层字段和 thinking 子对象，浅拷贝这两层即可，不必整体序列化再解析
+    const payload = { ...body };
+    if (payload.thinking && typeof payload.thinking === 'object' && !Array.isArray(payload.thinking)) {
+        payload.thinking = { ...payload.thinking };
+    }
+    payload.model = rewrittenModel;
+    applyTargetParamsToPayload(payload, target);
+    // Strip unsupported fields for MiniMax (Anthropic-specific params)
+    if (stripsMetadata) {
+        delete payload.metadata;
+    }
+    const forwardBody = Buffer.from(JSON.stringify(payload));
+    req._forwardBodyCache.set(cacheKey, forwardBody);
+    return forwardBody;
+}
+
+function applySelectedTarget(req, target, decision) {
+    req._selectedTarget = target;
+    req._targetInstance = target.instance;
+    req._targetUrl = target.target;
+    req._rewrittenModel = target.rewrite;
+    req._targetProvider = target.provider || null;
+    req._targetParamSummary = summarizeTargetParams(target?.params);
+    if (decision) {
+        req._routingDecision = decision;
+    }
+}
+
+// http-proxy 把 buffer 选项 pipe 到上游请求；已结束的 PassThrough 比 Readable.from 少一层异步迭代器
+function bufferToStream(buf) {
+    const stream = new PassThrough();
+    stream.end(buf);
+    return stream;
+}
+
+function forwardRequestToTarget(req, res, target, decision) {
+    applySelectedTarget(req, target, decision);
+    markTriedTarget(req, target);
+    req._attemptStartedAt = Date.now();
+    applyTargetHeaders(req, target);
+    const forwardBody = cloneRequestPayloadForTarget(req, target);
+    setForwardHeader(req, 'content-length', Buffer.byteLength(forwardBody));
+    proxy.web(req, res, {
+        target: target.target,
+        buffer: bufferToStream(forwardBody)
+    });
+}
+
+function pickRetryTarget(req) {
+    if (!req._model) return null;
+    const route = ROUTES[req._model];
+    if (!route) return null;
+    const currentIdentity = req._selectedTarget ? targetIdentity(req._selectedTarget) : null;
+    const candidates = getRouteCandidates(route, req._model);
+    const nextTargets = [];
+    const nextWeights = [];
+    for (let i = 0; i < candidates.targets.length; i++) {
+        const candidate = candidates.targets[i];
+        if (currentIdentity !== null && targetIdentity(candidate) === currentIdentity) {
+            continue;
+        }
+        if (hasTriedTarget(req, candidate)) {
+            continue;
+        }
+        nextTargets.push(candidate);
+        nextWeights.push(candidates.weights[i]);
+    }
+    if (!nextTargets.length) return null;
+    return weightedRandom(nextTargets, nextWeights);
+}
+
+// 响应解压走 libuv 线程池（默认 4 个线程），压缩响应很多时可调大 UV_THREADPOOL_SIZE
+// 上游都是本机 cliproxy 实例：复用长连接省掉每个请求的建连，关闭 Nagle 让 SSE 分片立即发出
+// （不传 agent 时 http-proxy 会给上游请求加 Connection: close）
+const upstreamAgent = new http.Agent({ keepAlive: true, noDelay: true, maxSockets: Infinity });
+
+const proxy = httpProxy.createProxyServer({
+    xfwd: true,
+    ws: true,
+    proxyTimeout: 300000,
+    selfHandleResponse: true,
+    agent: upstreamAgent
+});
+
+proxy.on('error', (err, req, res) => {
+    console.error('Proxy error:', err.message);
+    if (res && res.writeHead && !res.headersSent) {
+        res.writeHead(502, { 'Content-Type': 'application/json' });
+        res.end(JSON.stringify({ error: 'Proxy Error', details: err.message }));
+    }
+});
+
+proxy.on('proxyRes', (proxyRes, req, res) => {
+    const contentType = proxyRes.headers['content-type'] || '';
+    const isSSE = contentType.includes('text/event-stream');
+    if (isSSE) {
+        // SSE 需要尽快透传，避免客户端超时；响应头立即发出，并告知前置反向代理不要缓冲
+        const sseHeaders = { ...proxyRes.headers, 'x-accel-buffering': 'no' };
+        if (!sseHeaders['cache-control']) {
+            sseHeaders['cache-control'] = 'no-cache, no-transform';
+        }
+        res.writeHead(proxyRes.statusCode, sseHeaders);
+        res.flushHeaders();
+        if (res.socket) res.socket.setNoDelay(true);
+    }
+    const sseEncoding = isSSE ? getContentEncoding(proxyRes.headers) : '';
+    // 单次响应的状态集中在 ctx 里，data/end 处理函数放在模块顶层
+    const ctx = {
+        req,
+        res,
+        proxyRes,
+        startTime: req._startTime || Date.now(),
+        contentType,
+        isSSE,
+        chunks: [],
+        // SSE 边收边解码（压缩的先经流式解压）、边扫描 usage，只保留预览所需的开头部分，
+        // 长时间的流不会把整段对话留在内存里；无法流式解压的编码仍走整体解码
+        sseDecoder: isSSE && (!sseEncoding || RESPONSE_STREAM_DECOMPRESSORS.has(sseEncoding))
+            ? new StringDecoder('utf8')
+            : null,
+        sseEncoding,
+        sseInflater: null,
+        sseInflated: null,
+        sseDecodeError: null,
+        sseHead: '',
+        ssePendingLine: '',
+        sseUsage: null,
+        // 非 2xx 的 SSE 需要完整错误体做分类；错误体很小，保留全文
+        sseText: (proxyRes.statusCode >= 200 && proxyRes.statusCode < 300) ? null : '',
+        bodyLength: 0,
+        body: null,
+        bodyOffset: 0
+    };
+    // 已知 content-length 时预先分配整块缓冲，分片直接拷入，省掉结束时的 Buffer.concat
+    const contentLength = Number.parseInt(proxyRes.headers['content-length'] || '0', 10);
+    if (!ctx.sseDecoder && contentLength > 0 && contentLength <= PREALLOC_RESPONSE_BODY_LIMIT) {
+        ctx.body = Buffer.allocUnsafe(contentLength);
+    }
+    if (ctx.sseDecoder && sseEncoding) {
+        startSSEInflater(ctx);
+    }
+    proxyRes.on('data', (chunk) => handleProxyResponseData(ctx, chunk));
+    proxyRes.on('end', () => handleProxyResponseEnd(ctx));
+});
+
+function handleProxyResponseData(ctx, chunk) {
+    ctx.bodyLength += chunk.length;
+    if (ctx.sseInflater) {
+        if (!ctx.sseDecodeError) ctx.sseInflater.write(chunk);
+    } else if (ctx.sseDecoder) {
+        consumeSSEText(ctx, ctx.sseDecoder.write(chunk));
+    } else if (ctx.body && ctx.bodyOffset + chunk.length <= ctx.body.length) {
+        chunk.copy(ctx.body, ctx.bodyOffset);
+        ctx.bodyOffset += chunk.length;
+    } else {
+        if (ctx.body) {
+            // 实际长度超过 content-length，退回分片收集
+            ctx.chunks.push(ctx.body.subarray(0, ctx.bodyOffset));
+            ctx.body = null;
+        }
+        ctx.chunks.push(chunk);
+    }
+    if (ctx.isSSE) {
+        ctx.res.write(chunk);
+    }
+}
+
+function startSSEInflater(ctx) {
+    const inflater = RESPONSE_STREAM_DECOMPRESSORS.get(ctx.sseEncoding)();
+    inflater.on('data', (decoded) => consumeSSEText(ctx, ctx.sseDecoder.write(decoded)));
+    ctx.sseInflated = new Promise((resolve) => {
+        inflater.once('end', resolve);
+        // 出错后流已销毁，后续 write/end 可能再次触发 error，用 on 全部接住
+        inflater.on('error', (err) => {
+            if (!ctx.sseDecodeError) ctx.sseDecodeError = err?.message || 'decode_failed';
+            resolve();
+        });
+    });
+    ctx.sseInflater = inflater;
+}
+
+function consumeSSEText(ctx, text) {
+    if (!text) return;
+    if (ctx.sseText !== null) {
+        ctx.sseText += text;
+    } else if (ctx.sseHead.length <= RESPONSE_PREVIEW_LIMIT) {
+        // 多留一个字符，结束时据此判断预览是否被截断
+        ctx.sseHead += text.slice(0, RESPONSE_PREVIEW_LIMIT + 1 - ctx.sseHead.length);
+    }
+
+    const buffer = ctx.ssePendingLine + text;
+    let lineStart = 0;
+    let lineEnd = buffer.indexOf('\n');
+    while (lineEnd >= 0) {
+        takeSSEUsageLine(ctx, buffer.slice(lineStart, lineEnd));
+        lineStart = lineEnd + 1;
+        lineEnd = buffer.indexOf('\n', lineStart);
+    }
+    ctx.ssePendingLine = lineStart === 0 ? buffer : buffer.slice(lineStart);
+}
+
+// 与 extractUsageFromSSE 一致：取最后一条带 usage 的 data 行
+function takeSSEUsageLine(ctx, line) {
+    if (!line.startsWith('data: ') || !line.includes('"usage"')) return;
+    try {
+        const data = JSON.parse(line.slice(6));
+        if (data.usage) ctx.sseUsage = data.usage;
+    } catch (e) {}
+}
+
+function buildResponsePreview(text) {
+    return text.length > RESPONSE_PREVIEW_LIMIT
+        ? text.slice(0, RESPONSE_PREVIEW_LIMIT) + '...[truncated]'
+        : text;
+}
+
+// 只解码开头 RESPONSE_PREVIEW_LIMIT 字节，截断处的半个多字节字符会变成 U+FFFD
+function buildBufferPreview(buf) {
+    return buf.length > RESPONSE_PREVIEW_LIMIT
+        ? buf.subarray(0, RESPONSE_PREVIEW_LIMIT).toString('utf-8') + '...[truncated]'
+        : buf.toString('utf-8');
+}
+
+// 2xx 的非 JSON 响应：分类只看状态码，也没有 usage 可提取，响应体只用于日志预览
+function isOpaqueSuccessResponse(proxyRes, contentType) {
+    const statusCode = proxyRes.statusCode || 0;
+    return statusCode >= 200 && statusCode < 300 &&
+        !contentType.includes('application/json') &&
+        !contentType.includes('text/event-stream');
+}
+
+async function handleProxyResponseEnd(ctx) {
+    const { req, res, proxyRes, startTime, contentType, isSSE } = ctx;
+    const duration = Date.now() - startTime;
+    let decodedResponse;
+    let passthroughBody = null;
+    let responsePreview = null;
+    if (ctx.sseDecoder) {
+        if (ctx.sseInflater) {
+            ctx.sseInflater.end();
+            await ctx.sseInflated;
+        }
+        consumeSSEText(ctx, ctx.sseDecoder.end());
+        takeSSEUsageLine(ctx, ctx.ssePendingLine);
+        // 2xx 的 SSE 只保留了开头部分：分类不看响应体，usage 已在接收时提取；
+        // 解压失败时保留已解出的部分，并在日志里记录 decode_error
+        decodedResponse = {
+            bodyText: ctx.sseText !== null ? ctx.sseText : ctx.sseHead,
+            // 空响应体与整体解码一致：不算解压，也不报错
+            decodedFromEncoding: ctx.sseInflater && ctx.bodyLength > 0 && !ctx.sseDecodeError ? ctx.sseEncoding : null,
+            decodeError: ctx.bodyLength > 0 ? ctx.sseDecodeError : null
+        };
+    } else {
+        const rawBody = ctx.body ? ctx.body.subarray(0, ctx.bodyOffset) : Buffer.concat(ctx.chunks);
+        const opaque = isOpaqueSuccessResponse(proxyRes, contentType);
+        const encoding = getContentEncoding(proxyRes.headers);
+        if (opaque && encoding && !LOG_VERBOSE) {
+            // 压缩体连同 content-encoding 原样转给客户端，不解压；
+            // 紧凑日志里 2xx 不记 body_preview，只有 LOG_VERBOSE 时才需要解码
+            passthroughBody = rawBody;
+            decodedResponse = { bodyText: '', decodedFromEncoding: null, decodeError: null };
+        } else if (opaque && !encoding) {
+            // 未压缩：客户端直接拿原始 Buffer，日志预览只解码开头一段
+            passthroughBody = rawBody;
+            responsePreview = buildBufferPreview(rawBody);
+            decodedResponse = { bodyText: '', decodedFromEncoding: null, decodeError: null };
+        } else {
+            decodedResponse = await decodeResponseBody(rawBody, proxyRes.headers);
+        }
+    }
+    const responseBody = decodedResponse.bodyText;
+    if (responsePreview === null) {
+        responsePreview = buildResponsePreview(responseBody);
+    }
+    const attemptStartedAt = req._attemptStartedAt || startTime;
+    const attemptDuration = Date.now() - attemptStartedAt;
+
+    // JSON 响应体只解析一次，分类、usage 提取和错误信息改写共用
+    const parsedBody = parseJsonResponseBody(contentType, responseBody);
+
+    // 提取 token 使用信息
+    let usage = null;
+    const routeAction = classifyResponse(
+        proxyRes.statusCode || 0,
+        contentType,
+        responseBody,
+        req._hasThinkingSignature || false,
+        parsedBody
+    );
+    req._routeAction = routeAction.kind;
+    req._cooldownMsApplied = 0;
+    req._stickyAction = 'none';
+
+    if (req._stickyKey) {
+        if (routeAction.kind === 'success') {
+            if (req._selectedTarget) {
+                setStickyTarget(req._stickyKey, req._selectedTarget, req._stickySessionKey, req._stickyModel);
+                req._stickyAction = 'set_on_success';
+            }
+        } else if (routeAction.clearSticky) {
+            clearStickyTarget(req._stickyKey);
+            req._stickyAction = 'clear_on_error';
+        }
+    }
+    if (routeAction.cooldownMs > 0 && req._selectedTarget && req._model) {
+        setTargetCooldown(req._model, req._selectedTarget, routeAction.cooldownMs);
+        req._cooldownMsApplied = routeAction.cooldownMs;
+    }
+
+    const canRetry = !isSSE &&
+        req.method === 'POST' &&
+        (req._retryCount || 0) < MAX_TARGET_RETRIES &&
+        RETRYABLE_ROUTE_ACTIONS.has(routeAction.kind) &&
+        (routeAction.kind !== 'auth' ||
+            proxyRes.statusCode === 401 ||
+            proxyRes.statusCode === 403 ||
+            (RETRY_AUTH_ON_5XX && (proxyRes.statusCode || 0) >= 500)) &&
+        !res.headersSent;
+    if (canRetry) {
+        const retryTarget = pickRetryTarget(req);
+        if (retryTarget) {
+            if (!Array.isArray(req._retryTrace)) {
+                req._retryTrace = [];
+            }
+            req._retryTrace.push({
+                from_instance: req._targetInstance || null,
+                from_url: req._targetUrl || null,
+                from_model: req._rewrittenModel || req._model || null,
+                status_code: proxyRes.statusCode || 0,
+                route_action: routeAction.kind,
+                attempt_duration_ms: attemptDuration,
+                body_preview: responsePreview
+            });
+            req._retryCount = (req._retryCount || 0) + 1;
+            req._routingDecision = `retry_on_${routeAction.kind}`;
+            forwardRequestToTarget(req, res, retryTarget, req._routingDecision);
+            return;
+        }
+    }
+
+    // Signature 透明恢复：400 signature error → 找到正确 provider 重试，对客户端不可见
+    if (routeAction.kind === 'signature' && !res.headersSent && !req._signatureRetried) {
+        const sigGroup = req._thinkingGroup || null;
+        if (sigGroup) {
+            const recoveryModels = SIGNATURE_GROUP_ROUTES[sigGroup] || [];
+            for (const recoveryModel of recoveryModels) {
+                const recoveryRoute = ROUTES[recoveryModel];
+                if (!recoveryRoute) continue;
+                const candidates = getRouteCandidates(recoveryRoute, recoveryModel);
+                const recoveryTarget = pickHighestWeightCandidate(candidates);
+                if (recoveryTarget) {
+                    req._signatureRetried = true;
+                    req._model = recoveryModel;
+                    req._resolvedModel = recoveryModel;
+                    if (!Array.isArray(req._retryTrace)) req._retryTrace = [];
+                    req._retryTrace.push({
+                        attempt: req._retryCount || 0,
+                        target: req._selectedTarget,
+                        status: proxyRes.statusCode,
+                        route_action: routeAction.kind,
+                        sig_group: sigGroup,
+                        attempt_duration_ms: Date.now() - (req._attemptStartedAt || req._startTime || Date.now())
+                    });
+                    forwardRequestToTarget(req, res, recoveryTarget, `retry_on_signature_group_${sigGroup}`);
+                    return;
+                }
+            }
+        }
+    }
+
+    req._modelHealth = updateModelHealth(
+        req._modelHealthKey || null,
+        routeAction.kind === 'success'
+    );
+
+    if (ctx.sseDecoder) {
+        usage = ctx.sseUsage;
+    } else if (contentType.includes('text/event-stream')) {
+        usage = extractUsageFromSSE(responseBody);
+    } else if (contentType.includes('application/json')) {
+        usage = extractUsageFromJSON(responseBody, parsedBody);
+    }
+
+    if (isSSE) {
+        res.end();
+    } else {
+        const clientBody = passthroughBody || maybeNormalizeJsonErrorBody(contentType, responseBody, parsedBody);
+        const responseHeaders = copyResponseHeaders(proxyRes.headers, Boolean(decodedResponse.decodedFromEncoding));
+        if (!res.headersSent) {
+            res.writeHead(proxyRes.statusCode, responseHeaders);
+        }
+        res.end(clientBody);
+    }
+
+    const logEntry = LOG_VERBOSE
+        ? buildVerboseLogEntry(req, proxyRes, duration, ctx.bodyLength, responsePreview, decodedResponse, usage)
+        : buildCompactLogEntry(req, proxyRes, duration, ctx.bodyLength, responsePreview, decodedResponse, usage);
+    writeLog(logEntry);
+}
+
+// 完整日志条目（LOG_VERBOSE=1）：包含请求/响应头和完整请求体
+function buildVerboseLogEntry(req, proxyRes, duration, bodyLength, responsePreview, decodedResponse, usage) {
+    return {
+        timestamp: new Date().toISOString(),
+        duration_ms: duration,
+        request: {
+            method: req.method,
+            url: req.url,
+            headers: sanitizeHeaders(req.headers),
+            body: req._requestBody || null,
+            model: req._requestedModel || req._model || null,
+            client_ip: req._clientIp
+        },
+        routing: {
+            requested_model: req._requestedModel || null,
+            resolved_model: req._resolvedModel || req._model || null,
+            source_model: req._sourceModel || null,
+            target_instance: req._targetInstance || null,
+            target_url: req._targetUrl || null,
+            rewritten_model: req._rewrittenModel || null,
+            provider: req._targetProvider || null,
+            target_params: req._targetParamSummary || null,
+            hit_rule: req._modelRouter?.hit_rule || null,
+            factors: req._modelRouter?.factors || null,
+            eval_trace: req._modelRouter?.eval_trace || null,
+            model_router: req._modelRouter || null,
+            auto_upgrade: req._autoUpgrade || null,
+            model_health: req._modelHealth || null,
+            decision: req._routingDecision || null,
+            session_key_hash: req._sessionKeyHash || null,
+            has_thinking_signature: req._hasThinkingSignature || false,
+            sticky_action: req._stickyAction || 'none',
+            retry_count: req._retryCount || 0,
+            tried_targets: req._triedTargets || [],
+            retry_attempts: Array.isArray(req._retryTrace) ? req._retryTrace.length : 0,
+            retry_trace: Array.isArray(req._retryTrace) ? req._retryTrace : []
+        },
+        response: {
+            status_code: proxyRes.statusCode,
+            headers: proxyRes.headers,
+            body_length: bodyLength,
+            body_preview: responsePreview,
+            route_action: req._routeAction || null,
+            cooldown_ms_applied: req._cooldownMsApplied || 0,
+            decoded_content_encoding: decodedResponse.decodedFromEncoding || null,
+            decode_error: decodedResponse.decodeError || null
+        },
+        usage: usage
+    };
+}
+
+function setIfPresent(target, key, value) {
+    if (value) target[key] = value;
+}
+
+// 默认的精简日志条目：不记请求/响应头，model_router 内已含的 hit_rule/factors/eval_trace 不再重复，
+// 空值字段省略，响应预览只在非 2xx 时保留。usage_stats / router_optimizer 读取的字段都在
+function buildCompactLogEntry(req, proxyRes, duration, bodyLength, responsePreview, decodedResponse, usage) {
+    const request = {
+        method: req.method,
+        url: req.url,
+        model: req._requestedModel || req._model || null,
+        client_ip: req._clientIp
+    };
+    setIfPresent(request, 'body', summarizeRequestBody(req._requestBody));
+
+    const routing = {
+        requested_model: req._requestedModel || null,
+        resolved_model: req._resolvedModel || req._model || null,
+        decision: req._routingDecision || null,
+        sticky_action: req._stickyAction || 'none',
+        retry_count: req._retryCount || 0
+    };
+    setIfPresent(routing, 'source_model', req._sourceModel);
+    setIfPresent(routing, 'target_instance', req._targetInstance);
+    setIfPresent(routing, 'target_url', req._targetUrl);
+    setIfPresent(routing, 'rewritten_model', req._rewrittenModel);
+    setIfPresent(routing, 'provider', req._targetProvider);
+    setIfPresent(routing, 'target_params', req._targetParamSummary);
+    setIfPresent(routing, 'model_router', req._modelRouter);
+    setIfPresent(routing, 'auto_upgrade', req._autoUpgrade);
+    setIfPresent(routing, 'model_health', req._modelHealth);
+    setIfPresent(routing, 'session_key_hash', req._sessionKeyHash);
+    setIfPresent(routing, 'has_thinking_signature', req._hasThinkingSignature);
+    if (req._triedTargets?.length) routing.tried_targets = req._triedTargets;
+    if (req._retryTrace?.length) {
+        routing.retry_attempts = req._retryTrace.length;
+        routing.retry_trace = req._retryTrace;
+    }
+
+    const statusCode = proxyRes.statusCode;
+    const response = {
+        status_code: statusCode,
+        body_length: bodyLength
+    };
+    if (!(statusCode >= 200 && statusCode < 300)) setIfPresent(response, 'body_preview', responsePreview);
+    setIfPresent(response, 'route_action', req._routeAction);
+    setIfPresent(response, 'cooldown_ms_applied', req._cooldownMsApplied);
+    setIfPresent(response, 'decoded_content_encoding', decodedResponse.decodedFromEncoding);
+    setIfPresent(response, 'decode_error', decodedResponse.decodeError);
+
+    return {
+        timestamp: new Date().toISOString(),
+        duration_ms: duration,
+        request,
+        routing,
+        response,
+        usage: usage
+    };
+}
+
+// 冷却过滤后的临时候选集：一遍累加出前缀和，再二分查找落点
+// 前缀和数组；存在非正权重时返回 null，由调用方退回线性扫描
+function buildCumulativeWeights(weights) {
+    const n = weights.length;
+    const cumulative = new Float64Array(n);
+    let totalWeight = 0;
+    for (let i = 0; i < n; i++) {
+        const weight = weights[i];
+        if (typeof weight !== 'number' || !(weight > 0)) return null;
+        totalWeight += weight;
+        cumulative[i] = totalWeight;
+    }
+    return cumulative;
+}
+
+function pickByCumulativeWeight(targets, cumulative) {
+    const n = cumulative.length;
+    if (n === 0) return targets[0];
+    const random = Math.random() * cumulative[n - 1];
+    let lo = 0;
+    let hi = n - 1;
+    while (lo < hi) {
+        const mid = (lo + hi) >>> 1;
+        if (cumulative[mid] <= random) lo = mid + 1;
+        else hi = mid;
+    }
+    return targets[lo];
+}
+
+function weightedRandom(targets, weights) {
+    const cumulative = buildCumulativeWeights(weights);
+    return cumulative
+        ? pickByCumulativeWeight(targets, cumulative)
+        : weightedRandomLinear(targets, weights);
+}
+
+function weightedRandomLinear(targets, weights) {
+    let totalWeight = 0;
+    for (let i = 0; i < weights.length; i++) totalWeight += weights[i];
+    let random = Math.random() * totalWeight;
+    for (let i = 0; i < weights.length; i++) {
+        if (random < weights[i]) return targets[i];
+        random -= weights[i];
+    }
+    return targets[0];
+}
+
+function selectHighestWeightTarget(targets, weights) {
+    if (!targets.length) return null;
+    return targets[highestWeightIndex(weights)];
+}
+
+function highestWeightIndex(weights) {
+    let bestIdx = 0;
+    for (let i = 1; i < weights.length; i++) {
+        if (weights[i] > weights[bestIdx]) bestIdx = i;
+    }
+    return bestIdx;
+}
+
+// 静态候选集带生成时预建的 Vose alias 表和最高权重下标，抽样 O(1)；冷却过滤后的临时候选集走前缀和二分
+function pickWeightedCandidate(candidates) {
+    const table = candidates.aliasTable;
+    if (!table) {
+        // 冷却过滤后的候选集由 getRouteCandidates 缓存复用，前缀和挂在候选集上只建一次
+        if (candidates.cumulative === undefined) {
+            candidates.cumulative = buildCumulativeWeights(candidates.weights);
+        }
+        return candidates.cumulative
+            ? pickByCumulativeWeight(candidates.targets, candidates.cumulative)
+            : weightedRandomLinear(candidates.targets, candidates.weights);
+    }
+    const i = (Math.random() * table.prob.length) | 0;
+    return Math.random() < table.prob[i] ? candidates.targets[i] : candidates.targets[table.alias[i]];
+}
+
+function pickHighestWeightCandidate(candidates) {
+    if (candidates.bestIndex === undefined) {
+        return selectHighestWeightTarget(candidates.targets, candidates.weights);
+    }
+    return candidates.targets.length ? candidates.targets[candidates.bestIndex] : null;
+}
+
+// 会话键哈希只用作路由/日志里的标识，不需要密码学强度；cyrb53 风格的双 32 位混合，输出 12 位 hex
+function hashSessionKey(sessionKey) {
+    if (!sessionKey) return null;
+    let h1 = 0xdeadbeef;
+    let h2 = 0x41c6ce57;
+    for (let i = 0; i < sessionKey.length; i++) {
+        const ch = sessionKey.charCodeAt(i);
+        h1 = Math.imul(h1 ^ ch, 2654435761);
+        h2 = Math.imul(h2 ^ ch, 1597334677);
+    }
+    h1 = Math.imul(h1 ^ (h1 >>> 16), 2246822507) ^ Math.imul(h2 ^ (h2 >>> 13), 3266489909);
+    h2 = Math.imul(h2 ^ (h2 >>> 16), 2246822507) ^ Math.imul(h1 ^ (h1 >>> 13), 3266489909);
+    return (h2 >>> 0).toString(16).padStart(8, '0') + (h1 >>> 0).toString(16).padStart(8, '0').slice(0, 4);
+}
+
+function getSessionKey(req, body) {
+    if (body?.metadata?.user_id && typeof body.metadata.user_id === 'string') {
+        const userId = body.metadata.user_id.trim();
+        if (userId) return `metadata:${userId}`;
+    }
+    const headerCandidates = ['x-session-id', 'x-conversation-id', 'anthropic-conversation-id'];
+    for (const header of headerCandidates) {
+        const value = req.headers[header];
+        if (typeof value === 'string' && value.trim()) {
+            return `${header}:${value.trim()}`;
+        }
+    }
+    return null;
+}
+
+// 请求体解析后不再修改，thinking signature 的扫描结果按 body 缓存，
+// 路由、日志摘要和 auto upgrade 共用一次遍历；signature 分组在入口记到 req._thinkingGroup
+const thinkingSignatureInfo = new WeakMap();
+const NO_THINKING_SIGNATURE = Object.freeze({ hasSignature: false, group: null });
+
+function scanThinkingSignatures(messages) {
+    let hasSignature = false;
+    for (const message of messages) {
+        // thinking 块只会出现在 assistant 消息里，user/system（含大量 tool_result）直接跳过
+        if (message?.role !== 'assistant' || !Array.isArray(message.content)) continue;
+        for (const block of message.content) {
+            if (block?.type !== 'thinking' || typeof block.signature !== 'string') continue;
+            if (block.signature.length > 0) hasSignature = true;
+            const hashIdx = block.signature.indexOf('#');
+            if (hashIdx > 0) return { hasSignature: true, group: block.signature.slice(0, hashIdx) };
+        }
+    }
+    return hasSignature ? { hasSignature, group: null } : NO_THINKING_SIGNATURE;
+}
+
+function getThinkingSignatureInfo(body) {
+    if (!body || typeof body !== 'object' || !Array.isArray(body.messages)) return NO_THINKING_SIGNATURE;
+    let info = thinkingSignatureInfo.get(body);
+    if (!info) {
+        info = scanThinkingSignatures(body.messages);
+        thinkingSignatureInfo.set(body, info);
+    }
+    return info;
+}
+
+function hasThinkingSignature(body) {
+    return getThinkingSignatureInfo(body).hasSignature;
+}
+
+function modelHealthKey(sessionKeyHash, sourceModel) {
+    if (!sourceModel) return null;
+    return `${sessionKeyHash || 'anon'}::${sourceModel}`;
+}
+
+function getModelHealth(key) {
+    if (!key) return { failureStreak: 0, successStreak: 0, updatedAt: coarseNow };
+    const current = modelHealth.get(key);
+    if (!current) return { failureStreak: 0, successStreak: 0, updatedAt: coarseNow };
+    return current;
+}
+
+function updateModelHealth(key, isSuccess) {
+    if (!key) return null;
+    const current = getModelHealth(key);
+    const next = {
+        failureStreak: isSuccess ? 0 : (current.failureStreak || 0) + 1,
+        successStreak: isSuccess ? (current.successStreak || 0) + 1 : 0,
+        updatedAt: coarseNow
+    };
+    if (modelHealth.has(key)) {
+        modelHealth.delete(key);
+    } else if (modelHealth.size >= MAX_MODEL_HEALTH_KEYS) {
+        let evictCount = Math.ceil(MAX_MODEL_HEALTH_KEYS * 0.2);
+        for (const oldestKey of modelHealth.keys()) {
+            if (evictCount-- <= 0) break;
+            modelHealth.delete(oldestKey);
+        }
+    }
+    modelHealth.set(key, next);
+    return next;
+}
+
+function resolveAutoUpgradeModel(requestModel, body, sessionKeyHash, hasSignature = hasThinkingSignature(body)) {
+    if (!AUTO_UPGRADE_ENABLED) return null;
+    const targetModel = AUTO_UPGRADE_MODEL_MAP[requestModel];
+    if (typeof targetModel !== 'string' || targetModel.length === 0) return null;
+    if (ROUTES[targetModel] === undefined) return null;
+
+    const messagesCount = Array.isArray(body?.messages) ? body.messages.length : 0;
+    const toolsCount = Array.isArray(body?.tools) ? body.tools.length : 0;
+    const health = getModelHealth(modelHealthKey(sessionKeyHash, requestModel));
+    const failureStreak = health.failureStreak || 0;
+    const reasons = [];
+
+    if (messagesCount >= AUTO_UPGRADE_MESSAGES_THRESHOLD) reasons.push('messages_threshold');
+    if (toolsCount >= AUTO_UPGRADE_TOOLS_THRESHOLD) reasons.push('tools_threshold');
+    if (failureStreak >= AUTO_UPGRADE_FAILURE_STREAK_THRESHOLD) reasons.push('failure_streak');
+    if (AUTO_UPGRADE_SIGNATURE_ENABLED && hasSignature) reasons.push('thinking_signature');
+
+    if (!reasons.length) return null;
+    return {
+        sourceModel: requestModel,
+        targetModel,
+        reasons,
+        messagesCount,
+        toolsCount,
+        failureStreak
+    };
+}
+
+function stickyRouteKey(sessionKey, model) {
+    return `${sessionKey}::${model}`;
+}
+
+function targetCooldownKey(model, target) {
+    const identity = targetIdentity(target);
+    const keys = target._cooldownKeys;
+    return keys[model] || (keys[model] = `${model}::${identity}`);
+}
+
+function clearStickyTarget(key) {
+    if (!key) return;
+    const entry = stickyRoutes.get(key);
+    if (entry) deleteStickyRoute(key, entry);
+}
+
+// sessionKey -> 该会话当前有 sticky 的 model 集合；thinking 跨 model 锁定只需查这些 model
+const stickyModelsBySession = new Map();
+const ROUTE_ORDER = new Map(Object.keys(ROUTES).map((model, idx) => [model, idx]));
+
+function bindStickyKey(req, sessionKey, model) {
+    const key = stickyRouteKey(sessionKey, model);
+    req._stickyKey = key;
+    req._stickySessionKey = sessionKey;
+    req._stickyModel = model;
+    return key;
+}
+
+function deleteStickyRoute(key, entry) {
+    stickyRoutes.delete(key);
+    const models = stickyModelsBySession.get(entry.sessionKey);
+    if (!models) return;
+    models.delete(entry.model);
+    if (models.size === 0) stickyModelsBySession.delete(entry.sessionKey);
+}
+
+// 按 ROUTES 声明顺序返回该会话有 sticky 的 model，与逐个探测 ROUTES 的优先级一致
+function getStickyModelsForSession(sessionKey) {
+    const models = stickyModelsBySession.get(sessionKey);
+    if (!models) return [];
+    const ordered = [];
+    for (const model of models) {
+        if (ROUTE_ORDER.has(model)) ordered.push(model);
+    }
+    if (ordered.length > 1) ordered.sort((a, b) => ROUTE_ORDER.get(a) - ROUTE_ORDER.get(b));
+    return ordered;
+}
+
+// 每次设置冷却递增；删除过期条目不改变任何判断结果，无需递增
+let cooldownVersion = 0;
+
+function setTargetCooldown(model, target, cooldownMs) {
+    if (!model || !target || cooldownMs <= 0) return;
+    targetCooldowns.set(targetCooldownKey(model, target), {
+        expiresAt: coarseNow + cooldownMs
+    });
+    cooldownVersion++;
+}
+
+// 冷却中返回到期时间，否则返回 0
+function getTargetCooldownExpiry(model, target, now = coarseNow) {
+    const key = targetCooldownKey(model, target);
+    const entry = targetCooldowns.get(key);
+    if (!entry) return 0;
+    if (entry.expiresAt <= now) {
+        targetCooldowns.delete(key);
+        return 0;
+    }
+    return entry.expiresAt;
+}
+
+function isTargetCooling(model, target) {
+    return getTargetCooldownExpiry(model, target) > 0;
+}
+
+// 每个 route 的完整候选集（权重在生成时已补默认值、与 targets 等长）只构建一次；没有 target 处于冷却时
+// 直接复用，调用方只读不改
+const routeCandidateCache = new WeakMap();
+for (const [model, route] of Object.entries(ROUTES)) {
+    const picker = ROUTE_PICKERS[model];
+    if (picker) {
+        routeCandidateCache.set(route, buildStaticRouteCandidates(route, {
+            prob: new Float64Array(picker.prob),
+            alias: new Int32Array(picker.alias)
+        }, picker.best));
+    }
+}
+
+function buildStaticRouteCandidates(route, aliasTable, bestIndex) {
+    const weights = route.weights;
+    if (bestIndex === undefined) bestIndex = highestWeightIndex(weights);
+    return {
+        available: { targets: route.targets, weights, cooledOut: false, aliasTable, bestIndex },
+        cooledOut: { targets: route.targets, weights, cooledOut: true, aliasTable, bestIndex }
+    };
+}
+
+function getStaticRouteCandidates(route) {
+    let cached = routeCandidateCache.get(route);
+    if (!cached) {
+        cached = buildStaticRouteCandidates(route, null);
+        routeCandidateCache.set(route, cached);
+    }
+    return cached;
+}
+
+function getRouteCandidates(route, model) {
+    const cached = getStaticRouteCandidates(route);
+    const now = coarseNow;
+    // 冷却表没有新写入、且最早到期的冷却还没到期时，上次的过滤结果仍然有效
+    const filtered = cached.filtered;
+    if (filtered && filtered.version === cooldownVersion && filtered.model === model && now < filtered.validUntil) {
+        return filtered.value;
+    }
+
+    const allWeights = cached.available.weights;
+    let targets = null;
+    let weights = null;
+    let validUntil = Infinity;
+    for (let i = 0; i < route.targets.length; i++) {
+        const target = route.targets[i];
+        const expiresAt = getTargetCooldownExpiry(model, target, now);
+        if (expiresAt > 0) {
+            if (expiresAt < validUntil) validUntil = expiresAt;
+            if (!targets) {
+                targets = route.targets.slice(0, i);
+                weights = allWeights.slice(0, i);
+            }
+            continue;
+        }
+        if (targets) {
+            targets.push(target);
+            weights.push(allWeights[i]);
+        }
+    }
+    let value;
+    if (!targets) {
+        value = route.targets.length > 0 ? cached.available : cached.cooledOut;
+    } else if (targets.length === 0) {
+        value = cached.cooledOut;
+    } else {
+        value = { targets, weights, cooledOut: false, cumulative: undefined };
+    }
+    cached.filtered = { model, version: cooldownVersion, validUntil, value };
+    return value;
+}
+
+// route -> (targetIdentity -> target)，sticky 命中时按身份串直接取 target；同一身份重复出现时取第一个
+const routeTargetsByIdentity = new WeakMap();
+
+function findRouteTargetByIdentity(route, identity) {
+    let index = routeTargetsByIdentity.get(route);
+    if (!index) {
+        index = new Map();
+        for (const target of route.targets) {
+            const key = targetIdentity(target);
+            if (!index.has(key)) index.set(key, target);
+        }
+        routeTargetsByIdentity.set(route, index);
+    }
+    return index.get(identity) || null;
+}
+
+function getStickyTarget(route, key, model, options = {}) {
+    const ignoreCooldown = options.ignoreCooldown === true;
+    const entry = stickyRoutes.get(key);
+    if (!entry) return null;
+    if (entry.expiresAt <= coarseNow) {
+        deleteStickyRoute(key, entry);
+        return null;
+    }
+    const matched = findRouteTargetByIdentity(route, entry.identity);
+    if (!matched) {
+        deleteStickyRoute(key, entry);
+        return null;
+    }
+    if (!ignoreCooldown && isTargetCooling(model, matched)) {
+        deleteStickyRoute(key, entry);
+        return null;
+    }
+    entry.expiresAt = coarseNow + STICKY_ROUTE_TTL_MS;
+    stickyRoutes.delete(key);
+    stickyRoutes.set(key, entry);
+    return matched;
+}
+
+function setStickyTarget(key, target, sessionKey, model) {
+    if (stickyRoutes.has(key)) {
+        stickyRoutes.delete(key);
+    } else if (stickyRoutes.size >= MAX_STICKY_KEYS) {
+        let evictCount = Math.ceil(MAX_STICKY_KEYS * 0.2);
+        for (const [oldestKey, oldestEntry] of stickyRoutes) {
+            if (evictCount-- <= 0) break;
+            deleteStickyRoute(oldestKey, oldestEntry);
+        }
+    }
+    stickyRoutes.set(key, {
+        identity: targetIdentity(target),
+        sessionKey,
+        model,
+        expiresAt: coarseNow + STICKY_ROUTE_TTL_MS
+    });
+    let models = stickyModelsBySession.get(sessionKey);
+    if (!models) {
+        models = new Set();
+        stickyModelsBySession.set(sessionKey, models);
+    }
+    models.add(model);
+}
+
+function normalizeProxyPath(urlPath) {
+    if (!urlPath) return urlPath;
+    if (urlPath === '/v1/v1') return '/v1';
+    if (urlPath.startsWith('/v1/v1/')) return '/v1' + urlPath.slice('/v1/v1'.length);
+    return urlPath;
+}
+
+const server = http.createServer((req, res) => {
+    req._startTime = Date.now();
+    req._clientIp = req.socket?.remoteAddress || req.ip || req.headers['x-forwarded-for'] || 'unknown';
+    req.url = normalizeProxyPath(req.url);
+
+    if (req.method === 'POST') {
+        let body = [];
+        let bodyLength = 0;
+        let bodyTooLarge = false;
+        req.on('data', chunk => {
+            if (bodyTooLarge) return;
+            bodyLength += chunk.length;
+            // 超限请求直接 413，不再缓存和解析
+            if (bodyLength > MAX_REQUEST_BODY_BYTES) {
+                bodyTooLarge = true;
+                body = [];
+                res.writeHead(413, { 'Content-Type': 'application/json', 'Connection': 'close' });
+                res.end(JSON.stringify({ error: 'Request Too Large', details: `request body exceeds ${MAX_REQUEST_BODY_BYTES} bytes` }));
+                return;
+            }
+            body.push(chunk);
+        }).on('end', () => {
+            if (bodyTooLarge) return;
+            const rawBody = Buffer.concat(body, bodyLength);
+            const bodyStr = rawBody.toString();
+            let jsonBody, model;
+
+            try {
+                jsonBody = JSON.parse(bodyStr);
+                model = jsonBody.model;
+            } catch (e) {
+                req._requestBody = bodyStr;
+                proxy.web(req, res, { target: DEFAULT_TARGET, buffer: bufferToStream(rawBody) });
+                return;
+            }
+
+            req._requestBody = jsonBody;
+            req._rawBodyBuffer = rawBody;
+            req._requestedModel = model;
+            req._sourceModel = model;
+            req._model = model;
+            const thinkingInfo = getThinkingSignatureInfo(jsonBody);
+            req._hasThinkingSignature = thinkingInfo.hasSignature;
+            req._thinkingGroup = thinkingInfo.group;
+            req._retryCount = 0;
+            req._triedTargets = [];
+            req._retryTrace = [];
+            req._targetParamSummary = null;
+            req._autoUpgrade = null;
+            req._modelRouter = null;
+            req._resolvedModel = model;
+            const sessionKey = getSessionKey(req, jsonBody);
+            req._sessionKeyHash = hashSessionKey(sessionKey);
+            req._modelHealthKey = modelHealthKey(req._sessionKeyHash, req._sourceModel);
+
+            const modelRouter = resolveModelViaRouter(model, jsonBody, req._sessionKeyHash);
+            req._modelRouter = modelRouter;
+            if (modelRouter?.enabled && modelRouter?.activated && modelRouter?.applied && modelRouter?.resolved_model) {
+                model = modelRouter.resolved_model;
+                req._model = model;
+            }
+
+            const autoUpgrade = resolveAutoUpgradeModel(model, jsonBody, req._sessionKeyHash, req._hasThinkingSignature);
+            if (autoUpgrade) {
+                model = autoUpgrade.targetModel;
+                req._model = model;
+                req._autoUpgrade = autoUpgrade;
+            }
+            req._resolvedModel = model;
+
+            let route = ROUTES[model];
+            if (!route) {
+                req._targetUrl = DEFAULT_TARGET;
+                req._routingDecision = 'default_target';
+                proxy.web(req, res, { target: DEFAULT_TARGET, buffer: bufferToStream(rawBody) });
+                return;
+            }
+
+            let selected = null;
+            let routingDecision = 'weighted_random';
+            if (req._autoUpgrade) {
+                routingDecision = `auto_upgrade_${req._autoUpgrade.sourceModel}_to_${req._autoUpgrade.targetModel}`;
+            } else if (req._modelRouter?.enabled && req._modelRouter?.activated) {
+                routingDecision = req._modelRouter.applied
+                    ? `model_router_${req._modelRouter.decision || 'resolved'}`
+                    : `model_router_${req._modelRouter.decision || 'passthrough'}`;
+            }
+
+            // thinking cross-model sticky: 当 session 已在某 model 上有 sticky 时，锁定回去
+            // 避免 model router 切换 model 导致 thinking signature 跨 provider 失效
+            if (req._hasThinkingSignature && sessionKey) {
+                for (const candidateModel of getStickyModelsForSession(sessionKey)) {
+                    const candidateRoute = ROUTES[candidateModel];
+                    if (!candidateRoute) continue;
+                    const candidateStickyKey = stickyRouteKey(sessionKey, candidateModel);
+                    const candidateSticky = getStickyTarget(candidateRoute, candidateStickyKey, candidateModel, { ignoreCooldown: true });
+                    if (candidateSticky) {
+                        model = candidateModel;
+                        req._model = model;
+                        req._resolvedModel = model;
+                        route = candidateRoute;
+                        selected = candidateSticky;
+                        bindStickyKey(req, sessionKey, candidateModel);
+                        routingDecision = 'thinking_sticky_cross_model_locked';
+                        break;
+                    }
+                }
+            }
+
+            if (req._hasThinkingSignature && !selected) {
+                if (sessionKey) {
+                    const key = bindStickyKey(req, sessionKey, model);
+                    // Thinking 会话必须保持同链路，避免 signature 跨后端失效。
+                    selected = getStickyTarget(route, key, model, { ignoreCooldown: true });
+                    if (selected) {
+                        routingDecision = 'sticky_session_model_thinking_locked';
+                    } else {
+                        const candidates = getRouteCandidates(route, model);
+                        selected = pickHighestWeightCandidate(candidates);
+                        routingDecision = candidates.cooledOut
+                            ? 'thinking_primary_locked_all_targets_in_cooldown'
+                            : 'thinking_primary_locked';
+                    }
+                } else {
+                    const candidates = getRouteCandidates(route, model);
+                    selected = pickHighestWeightCandidate(candidates);
+                    routingDecision = candidates.cooledOut
+                        ? 'thinking_primary_locked_no_session_all_targets_in_cooldown'
+                        : 'thinking_primary_locked_no_session';
+                }
+            } else if (!req._hasThinkingSignature) {
+                if (sessionKey) {
+                    const key = bindStickyKey(req, sessionKey, model);
+                    selected = getStickyTarget(route, key, model);
+                    if (selected) {
+                        routingDecision = 'sticky_session_model';
+                    } else {
+                        const candidates = getRouteCandidates(route, model);
+                        selected = pickWeightedCandidate(candidates);
+                        routingDecision = candidates.cooledOut ? 'weighted_random_all_targets_in_cooldown' : 'weighted_random';
+                    }
+                } else {
+                    const candidates = getRouteCandidates(route, model);
+                    selected = pickWeightedCandidate(candidates);
+                    routingDecision = candidates.cooledOut ? 'weighted_random_no_session_all_targets_in_cooldown' : 'weighted_random';
+                }
+            }
+
+            if (!selected) {
+                req._targetUrl = DEFAULT_TARGET;
+                req._routingDecision = 'default_target_no_selected';
+                proxy.web(req, res, { target: DEFAULT_TARGET, buffer: bufferToStream(rawBody) });
+                return;
+            }
+
+            forwardRequestToTarget(req, res, selected, routingDecision);
+        });
+    } else {
+        // 非 POST 请求（如 GET），直接转发
+        proxy.web(req, res, { target: DEFAULT_TARGET });
+    }
+});
+
+server.on('upgrade', (req, socket, head) => {
+    req.url = normalizeProxyPath(req.url);
+    proxy.ws(req, socket, head, { target: DEFAULT_TARGET });
+});
+
+console.log(`🚀 Node.js Smart LB running on port ${PORT}`);
+console.log(`📁 Request logs: ${LOG_DIR}`);
+console.log(`🗑️ Log retention: ${LOG_RETENTION_DAYS} days`);
+server.listen(PORT);
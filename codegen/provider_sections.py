@@ -1,18 +1,19 @@
 """Provider section builders for instance YAML generation."""
 
-from typing import Callable, Dict, List, Any
+from collections import defaultdict
+from typing import Callable, DefaultDict, Dict, List, Any, Tuple
 
 
 CLAUDE_COMPAT_PROVIDER_TYPES = {"anthropic", "minimax"}
 
 
-def _collect_models_for_provider(
+def _index_routing(
     instance_name: str,
-    provider_type: str,
     routing: Dict[str, Any],
     warn_fn: Callable[[str], None],
-) -> List[str]:
-    models: List[str] = []
+) -> Dict[str, Dict[str, None]]:
+    """按 provider 类型汇总该实例的内部模型，dict 作有序集合保持首次出现顺序。"""
+    index: DefaultDict[str, Dict[str, None]] = defaultdict(dict)
     for expose_id, targets in routing.items():
         for target in targets:
             if target.get("instance") != instance_name:
@@ -23,13 +24,62 @@ def _collect_models_for_provider(
                 warn_fn(f"⚠️  警告: 路由 '{expose_id}' -> '{instance_name}' 未指定 provider 类型，跳过")
                 continue
 
-            if target_provider != provider_type:
-                continue
-
-            internal_model = target["model"]
-            if internal_model not in models:
-                models.append(internal_model)
-    return models
+            index[target_provider][target["model"]] = None
+    return index
+
+
+def _build_per_key_entries(
+    provider_name: str,
+    base_url: str,
+    api_keys: List[str],
+    models: List[str],
+) -> List[Dict[str, Any]]:
+    """claude-api-key / vertex-api-key：每个 key 一条记录。"""
+    entries: List[Dict[str, Any]] = []
+    # 同一 provider 的所有 key 共用一份 models 列表（只读，直接序列化为 YAML）
+    models_block = [{"name": model, "alias": model} for model in models] if models and api_keys else None
+    for key in api_keys:
+        entry: Dict[str, Any] = {
+            "api-key": key,
+            "base-url": base_url,
+        }
+        if models_block:
+            entry["models"] = models_block
+        entries.append(entry)
+    return entries
+
+
+def _build_openai_compat_entries(
+    provider_name: str,
+    base_url: str,
+    api_keys: List[str],
+    models: List[str],
+) -> List[Dict[str, Any]]:
+    """openai-compatibility：一个 provider 一条记录，多个 key 放进 api-key-entries。"""
+    entry: Dict[str, Any] = {
+        "name": provider_name,
+        "base-url": base_url,
+        "api-key-entries": [{"api-key": key} for key in api_keys],
+    }
+    if models:
+        entry["models"] = [{"name": model, "alias": model} for model in models]
+    return [entry]
+
+
+EntryBuilder = Callable[[str, str, List[str], List[str]], List[Dict[str, Any]]]
+
+# provider 类型 -> (YAML 段名, 条目构造函数)
+# anthropic/minimax(anthropic-compatible) -> claude-api-key
+# openai -> openai-compatibility
+# gemini(第三方 Vertex 风格 API) -> vertex-api-key
+# antigravity/codex 等 OAuth 类型由 auth-dir 自动加载，无需额外配置，不在表中
+_PROVIDER_HANDLERS: Dict[str, Tuple[str, EntryBuilder]] = {
+    **{provider_type: ("claude-api-key", _build_per_key_entries) for provider_type in CLAUDE_COMPAT_PROVIDER_TYPES},
+    "openai": ("openai-compatibility", _build_openai_compat_entries),
+    "gemini": ("vertex-api-key", _build_per_key_entries),
+}
+# 输出段的固定顺序，与 provider 在配置中的先后无关
+_SECTION_ORDER = ("claude-api-key", "openai-compatibility", "vertex-api-key")
 
 
 def build_provider_sections(
@@ -38,62 +88,22 @@ def build_provider_sections(
     routing: Dict[str, Any],
     warn_fn: Callable[[str], None] = print,
 ) -> Dict[str, Any]:
-    claude_keys: List[Dict[str, Any]] = []
-    openai_compat: List[Dict[str, Any]] = []
-    vertex_keys: List[Dict[str, Any]] = []
+    collected: Dict[str, List[Dict[str, Any]]] = {section: [] for section in _SECTION_ORDER}
+
+    models_by_provider = _index_routing(instance_name, routing, warn_fn) if providers else {}
 
     for idx, provider_raw in enumerate(providers):
         provider_type = provider_raw["type"]
-        provider_name = f"{instance_name}-{provider_type}-{idx}"
-        base_url = provider_raw.get("base_url", "")
-        api_keys = provider_raw.get("api_keys", [])
-
-        models = _collect_models_for_provider(instance_name, provider_type, routing, warn_fn)
-
-        # anthropic/minimax(anthropic-compatible) -> claude-api-key
-        if provider_type in CLAUDE_COMPAT_PROVIDER_TYPES:
-            for key in api_keys:
-                entry: Dict[str, Any] = {
-                    "api-key": key,
-                    "base-url": base_url,
-                }
-                if models:
-                    entry["models"] = [{"name": model, "alias": model} for model in models]
-                claude_keys.append(entry)
-            continue
-
-        # openai -> openai-compatibility
-        if provider_type == "openai":
-            entry = {
-                "name": provider_name,
-                "base-url": base_url,
-                "api-key-entries": [{"api-key": key} for key in api_keys],
-            }
-            if models:
-                entry["models"] = [{"name": model, "alias": model} for model in models]
-            openai_compat.append(entry)
-            continue
-
-        # gemini(第三方 Vertex 风格 API) -> vertex-api-key
-        if provider_type == "gemini":
-            for key in api_keys:
-                entry = {
-                    "api-key": key,
-                    "base-url": base_url,
-                }
-                if models:
-                    entry["models"] = [{"name": model, "alias": model} for model in models]
-                vertex_keys.append(entry)
+        handler = _PROVIDER_HANDLERS.get(provider_type)
+        if handler is None:
             continue
 
-        # antigravity/codex 等 OAuth 类型由 auth-dir 自动加载，无需额外配置
-
-    sections: Dict[str, Any] = {}
-    if claude_keys:
-        sections["claude-api-key"] = claude_keys
-    if openai_compat:
-        sections["openai-compatibility"] = openai_compat
-    if vertex_keys:
-        sections["vertex-api-key"] = vertex_keys
-    return sections
+        section, build_entries = handler
+        collected[section].extend(build_entries(
+            f"{instance_name}-{provider_type}-{idx}",
+            provider_raw.get("base_url", ""),
+            provider_raw.get("api_keys", []),
+            list(models_by_provider.get(provider_type, {})),
+        ))
 
+    return {section: entries for section, entries in collected.items() if entries}
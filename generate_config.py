@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
-import toml
 import yaml
 import os
 import sys
 import json
 import re
+import subprocess
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
 
 from codegen.provider_sections import build_provider_sections
-from codegen.lb_codegen import create_node_lb_script
+from codegen.lb_codegen import coerce_bool, coerce_int, create_node_lb_script
 
 # 配置路径 (使用脚本所在目录)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -15,31 +20,87 @@ TOML_FILE = os.path.join(BASE_DIR, "providers.toml")
 ENV_FILE = os.path.join(BASE_DIR, ".env")
 OUTPUT_DIR = os.path.join(BASE_DIR, "instances")
 PM2_FILE = os.path.join(BASE_DIR, "ecosystem.config.js")
+# 未做环境变量替换的 TOML 解析结果，按源文件 (mtime_ns, size) 失效
+TOML_CACHE_FILE = TOML_FILE + ".cache.json"
+
+_ENV_PATTERN = re.compile(r'\$\{([^}]+)\}')
+
+# 有 LibYAML 时用 C 实现的 emitter；配置里只有基础类型，Safe 版本足够
+_YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+class _NoAliasDumper(_YAML_DUMPER):
+    """共享的子对象（如多个 key 共用的 models 列表）展开输出，不生成 &id/*id 锚点"""
+
+    def ignore_aliases(self, data):
+        return True
 
 def load_env():
     """加载 .env 文件到环境变量"""
-    if os.path.exists(ENV_FILE):
-        print(f"📄 加载环境变量: {ENV_FILE}")
-        with open(ENV_FILE) as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('#'): continue
-                if '=' in line:
-                    key, value = line.split('=', 1)
-                    os.environ[key.strip()] = value.strip()
+    try:
+        f = open(ENV_FILE, buffering=65536)
+    except FileNotFoundError:
+        return
+    print(f"📄 加载环境变量: {ENV_FILE}")
+    with f:
+        for line in f:
+            line = line.strip()
+            if not line or line[0] == '#': continue
+            key, sep, value = line.partition('=')
+            if sep:
+                os.environ[key.rstrip()] = value.lstrip()
+
+def _env_replacement(match):
+    return os.environ.get(match.group(1), match.group(0))
 
 def substitute_env(data):
-    """递归替换配置中的环境变量占位符 ${VAR}"""
-    if isinstance(data, dict):
-        return {k: substitute_env(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [substitute_env(v) for v in data]
-    elif isinstance(data, str):
-        # 查找 ${VAR} 模式
-        return re.sub(r'\$\{([^}]+)\}', lambda m: os.environ.get(m.group(1), m.group(0)), data)
-    else:
+    """原地替换配置中的环境变量占位符 ${VAR}，返回 data 本身"""
+    if isinstance(data, str):
+        # 不含占位符的字符串（绝大多数）直接返回
+        return _ENV_PATTERN.sub(_env_replacement, data) if "${" in data else data
+    if not isinstance(data, (dict, list)):
         return data
 
+    # 显式栈代替递归，直接改写原容器；seen 避免重复遍历共享的子树
+    seen = {id(data)}
+    stack = [data]
+    while stack:
+        container = stack.pop()
+        items = container.items() if isinstance(container, dict) else enumerate(container)
+        for key, value in items:
+            if isinstance(value, str):
+                if "${" in value:
+                    container[key] = _ENV_PATTERN.sub(_env_replacement, value)
+            elif isinstance(value, (dict, list)) and id(value) not in seen:
+                seen.add(id(value))
+                stack.append(value)
+    return data
+
+def read_toml_cached(toml_path, cache_path):
+    stat = os.stat(toml_path)
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached.get("_src_mtime") == stat.st_mtime_ns and cached.get("_src_size") == stat.st_size:
+            return cached["data"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+    with open(toml_path, "rb") as f:
+        raw_data = tomllib.load(f)
+
+    # 写临时文件再替换，避免并发生成时读到半截缓存；含日期时间等非 JSON 类型时不缓存
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump({"_src_mtime": stat.st_mtime_ns, "_src_size": stat.st_size, "data": raw_data}, f)
+        os.replace(tmp_path, cache_path)
+    except (OSError, TypeError, ValueError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return raw_data
+
 def load_toml():
     if not os.path.exists(TOML_FILE):
         print(f"❌ 错误: 找不到配置文件 {TOML_FILE}")
@@ -48,51 +109,42 @@ def load_toml():
     # 1. 加载 .env
     load_env()
 
-    # 2. 读取 TOML
-    raw_data = toml.load(TOML_FILE)
+    # 2. 读取 TOML（源文件未变时直接读 JSON 缓存）
+    raw_data = read_toml_cached(TOML_FILE, TOML_CACHE_FILE)
 
     # 3. 替换变量
     return substitute_env(raw_data)
 
 def ensure_dir(path):
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-def coerce_bool(value):
-    if isinstance(value, bool):
-        return value
-    if isinstance(value, (int, float)):
-        return value != 0
-    if isinstance(value, str):
-        normalized = value.strip().lower()
-        if normalized in {"1", "true", "yes", "y", "on"}:
-            return True
-        if normalized in {"0", "false", "no", "n", "off", ""}:
-            return False
-    raise ValueError(f"invalid boolean value: {value}")
-
-def coerce_int(value):
-    if isinstance(value, bool):
-        return int(value)
-    if isinstance(value, int):
-        return value
-    if isinstance(value, float):
-        return int(value)
-    if isinstance(value, str):
-        return int(value.strip())
-    raise ValueError(f"invalid integer value: {value}")
-
-def pick_conf(instance_conf, global_conf, key):
-    if key in instance_conf:
-        return instance_conf[key]
-    return global_conf.get(key)
+    os.makedirs(path, exist_ok=True)
+
+def normalize_section_keys(section):
+    """嵌套配置段的 key 统一成下划线写法；两种写法并存时下划线优先"""
+    if not isinstance(section, dict):
+        return {}
+    normalized = {key.replace("-", "_"): value for key, value in section.items() if "-" in key}
+    normalized.update((key, value) for key, value in section.items() if "-" not in key)
+    return normalized
+
+def first_present(*values):
+    for value in values:
+        if value is not None:
+            return value
+    return None
 
 def generate_instance_config(name, instance_conf, routing, global_conf):
     """生成物理实例配置 (兼容当前 cliproxy 配置格式)"""
 
-    request_retry = instance_conf.get("request_retry", global_conf.get("request_retry", 3))
-    max_retry_interval = instance_conf.get("max_retry_interval", global_conf.get("max_retry_interval", 30))
-    routing_strategy = instance_conf.get("routing_strategy", global_conf.get("routing_strategy"))
+    # 实例配置覆盖全局配置，合并一次后统一查找
+    conf = {**global_conf, **instance_conf}
+    instance_streaming = normalize_section_keys(instance_conf.get("streaming"))
+    global_streaming = normalize_section_keys(global_conf.get("streaming"))
+    instance_quota = normalize_section_keys(instance_conf.get("quota_exceeded"))
+    global_quota = normalize_section_keys(global_conf.get("quota_exceeded"))
+
+    request_retry = conf.get("request_retry", 3)
+    max_retry_interval = conf.get("max_retry_interval", 30)
+    routing_strategy = conf.get("routing_strategy")
 
     yaml_conf = {
         "host": global_conf.get("host", "0.0.0.0"),
@@ -105,42 +157,33 @@ def generate_instance_config(name, instance_conf, routing, global_conf):
     if routing_strategy:
         yaml_conf["routing"] = {"strategy": routing_strategy}
 
-    request_log = pick_conf(instance_conf, global_conf, "request_log")
+    request_log = conf.get("request_log")
     if request_log is not None:
         yaml_conf["request-log"] = coerce_bool(request_log)
 
-    logs_max_total_size_mb = pick_conf(instance_conf, global_conf, "logs_max_total_size_mb")
+    logs_max_total_size_mb = conf.get("logs_max_total_size_mb")
     if logs_max_total_size_mb is not None:
         yaml_conf["logs-max-total-size-mb"] = max(0, coerce_int(logs_max_total_size_mb))
 
-    disable_cooling = pick_conf(instance_conf, global_conf, "disable_cooling")
+    disable_cooling = conf.get("disable_cooling")
     if disable_cooling is not None:
         yaml_conf["disable-cooling"] = coerce_bool(disable_cooling)
 
-    nonstream_keepalive_interval = pick_conf(instance_conf, global_conf, "nonstream_keepalive_interval")
+    nonstream_keepalive_interval = conf.get("nonstream_keepalive_interval")
     if nonstream_keepalive_interval is not None:
         yaml_conf["nonstream-keepalive-interval"] = max(0, coerce_int(nonstream_keepalive_interval))
 
-    instance_streaming = instance_conf.get("streaming", {}) if isinstance(instance_conf.get("streaming"), dict) else {}
-    global_streaming = global_conf.get("streaming", {}) if isinstance(global_conf.get("streaming"), dict) else {}
-
-    keepalive_seconds = (
-        instance_streaming.get("keepalive_seconds", instance_streaming.get("keepalive-seconds"))
-        if instance_streaming else None
+    # 优先级: 实例 [streaming] > 平铺的 streaming_* (实例 > 全局) > 全局 [streaming]
+    keepalive_seconds = first_present(
+        instance_streaming.get("keepalive_seconds"),
+        conf.get("streaming_keepalive_seconds"),
+        global_streaming.get("keepalive_seconds"),
     )
-    if keepalive_seconds is None:
-        keepalive_seconds = pick_conf(instance_conf, global_conf, "streaming_keepalive_seconds")
-    if keepalive_seconds is None:
-        keepalive_seconds = global_streaming.get("keepalive_seconds", global_streaming.get("keepalive-seconds"))
-
-    bootstrap_retries = (
-        instance_streaming.get("bootstrap_retries", instance_streaming.get("bootstrap-retries"))
-        if instance_streaming else None
+    bootstrap_retries = first_present(
+        instance_streaming.get("bootstrap_retries"),
+        conf.get("streaming_bootstrap_retries"),
+        global_streaming.get("bootstrap_retries"),
     )
-    if bootstrap_retries is None:
-        bootstrap_retries = pick_conf(instance_conf, global_conf, "streaming_bootstrap_retries")
-    if bootstrap_retries is None:
-        bootstrap_retries = global_streaming.get("bootstrap_retries", global_streaming.get("bootstrap-retries"))
 
     streaming_conf = {}
     if keepalive_seconds is not None:
@@ -150,20 +193,17 @@ def generate_instance_config(name, instance_conf, routing, global_conf):
     if streaming_conf:
         yaml_conf["streaming"] = streaming_conf
 
-    instance_quota = instance_conf.get("quota_exceeded", {}) if isinstance(instance_conf.get("quota_exceeded"), dict) else {}
-    global_quota = global_conf.get("quota_exceeded", {}) if isinstance(global_conf.get("quota_exceeded"), dict) else {}
-
-    switch_project = pick_conf(instance_conf, global_conf, "quota_switch_project")
-    if switch_project is None:
-        switch_project = instance_quota.get("switch_project", instance_quota.get("switch-project"))
-    if switch_project is None:
-        switch_project = global_quota.get("switch_project", global_quota.get("switch-project"))
-
-    switch_preview_model = pick_conf(instance_conf, global_conf, "quota_switch_preview_model")
-    if switch_preview_model is None:
-        switch_preview_model = instance_quota.get("switch_preview_model", instance_quota.get("switch-preview-model"))
-    if switch_preview_model is None:
-        switch_preview_model = global_quota.get("switch_preview_model", global_quota.get("switch-preview-model"))
+    # 优先级: 平铺的 quota_* (实例 > 全局) > 实例 [quota_exceeded] > 全局 [quota_exceeded]
+    switch_project = first_present(
+        conf.get("quota_switch_project"),
+        instance_quota.get("switch_project"),
+        global_quota.get("switch_project"),
+    )
+    switch_preview_model = first_present(
+        conf.get("quota_switch_preview_model"),
+        instance_quota.get("switch_preview_model"),
+        global_quota.get("switch_preview_model"),
+    )
 
     quota_conf = {}
     if switch_project is not None:
@@ -186,8 +226,9 @@ def generate_instance_config(name, instance_conf, routing, global_conf):
 def ensure_node_deps(base_dir):
     """确保 http-proxy 依赖已安装"""
     pkg_file = os.path.join(base_dir, "package.json")
-    if not os.path.exists(pkg_file):
-        with open(pkg_file, "w") as f:
+    try:
+        # "x" 独占创建：文件已存在时直接抛错，省掉单独的 exists 检查
+        with open(pkg_file, "x") as f:
             json.dump({
                 "name": "cliproxy-lb",
                 "version": "1.0.0",
@@ -197,11 +238,26 @@ def ensure_node_deps(base_dir):
                 }
             }, f, indent=2)
         print("📦 初始化 package.json")
+    except FileExistsError:
+        pass
 
     node_modules = os.path.join(base_dir, "node_modules")
     if not os.path.exists(node_modules):
         print("📦 安装 Node.js 依赖 (http-proxy)...")
-        os.system(f"cd {base_dir} && npm install")
+        # 有 lockfile 时先用 npm ci，跳过依赖解析；lockfile 与 package.json 不一致时
+        # npm ci 会拒绝安装，退回 npm install。不经过 shell，路径含空格也没问题
+        npm_cmds = []
+        if os.path.exists(os.path.join(base_dir, "package-lock.json")):
+            npm_cmds.append(["npm", "ci", "--no-audit", "--no-fund", "--prefer-offline"])
+        npm_cmds.append(["npm", "install", "--no-audit", "--no-fund"])
+        try:
+            for npm_cmd in npm_cmds:
+                if subprocess.run(npm_cmd, cwd=base_dir, check=False).returncode == 0:
+                    break
+            else:
+                print("⚠️  警告: Node.js 依赖安装失败，请手动执行 npm install")
+        except OSError as e:
+            print(f"⚠️  警告: 无法执行 npm ({e})")
 
 def validate_config(instances, routing):
     """校验配置有效性"""
@@ -269,7 +325,7 @@ def main():
         yaml_file = os.path.join(OUTPUT_DIR, f"{name}.yaml")
 
         with open(yaml_file, "w") as f:
-            yaml.dump(yaml_content, f, sort_keys=False)
+            yaml.dump(yaml_content, f, Dumper=_NoAliasDumper, sort_keys=False)
         print(f"✅ 生成实例配置 ({name}): {yaml_file}")
 
         pm2_apps.append({
@@ -297,7 +353,10 @@ def main():
         "autorestart": True,
         "out_file": os.path.join(log_dir, "lb-access.log"),
         "error_file": os.path.join(log_dir, "lb-error.log"),
-        "merge_logs": True
+        "merge_logs": True,
+        # lb.js 是启动时一次性生成的大脚本, 用 Node 内置的磁盘编译缓存省掉重启时的解析/编译;
+        # Node >= 22.1 生效, 旧版本忽略该变量; 脚本内容变化时缓存自动失效
+        "env": {"NODE_COMPILE_CACHE": os.path.join(BASE_DIR, ".node-compile-cache")}
     })
 
     # 3. 写入 PM2 配置